@@ -7,13 +7,20 @@ import os
 import atexit
 import tempfile
 import json
+import sqlite3
 import threading
 
+from concurrent.futures import CancelledError
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
-from time import sleep, time
-from typing import IO, Any, TextIO, cast
+from collections import Counter
+from random import uniform
+from time import monotonic, sleep, time
+from typing import IO, Any, TextIO, cast, overload
+from collections.abc import AsyncIterable
+from collections.abc import AsyncIterator
 from collections.abc import Iterable
+from collections.abc import Iterator
 from collections.abc import Callable
 
 _osDir = tempfile.mkdtemp()
@@ -35,6 +42,7 @@ sys.path.append(os.path.join(_osDir, "lib/system"))
 
 import _os  # noqa: E402 #pyright:ignore [reportMissingImports]
 import _os.podman  # noqa: E402 #pyright:ignore [reportMissingImports]
+import _os.registry  # noqa: E402 #pyright:ignore [reportMissingImports]
 import _os.system  # noqa: E402 #pyright:ignore [reportMissingImports]
 
 podman = cast(Callable[..., None], _os.podman.podman)  # pyright:ignore [reportUnknownMemberType]
@@ -51,11 +59,50 @@ image_info = cast(Callable[[str, bool], dict[str, object]], _os.podman.image_inf
 image_labels = cast(Callable[[str, bool], dict[str, str]], _os.podman.image_labels)  # pyright:ignore [reportUnknownMemberType]
 image_exists = cast(Callable[[str, bool, bool], bool], _os.podman.image_exists)  # pyright:ignore [reportUnknownMemberType]
 image_tags = cast(Callable[[str, bool], list[str]], _os.podman.image_tags)  # pyright:ignore [reportUnknownMemberType]
-create_delta = cast(Callable[[str, str, str, bool], bool], _os.podman.create_delta)  # pyright:ignore [reportUnknownMemberType]
+create_delta = cast(Callable[..., bool], _os.podman.create_delta)  # pyright:ignore [reportUnknownMemberType]
+estimate_delta_ratio = cast(
+    Callable[[str, str], float | None],
+    _os.podman.estimate_delta_ratio,  # pyright: ignore[reportUnknownMemberType]
+)
+delta_is_hopeless = cast(
+    Callable[[float | None, list[tuple[float, float]]], bool],
+    _os.podman.delta_is_hopeless,  # pyright: ignore[reportUnknownMemberType]
+)
+ArchiveCache = cast(
+    Callable[[str, int], object],
+    _os.podman.ArchiveCache,  # pyright: ignore[reportUnknownMemberType]
+)
+ManifestSession = cast(
+    Callable[[str], Any],  # pyright: ignore[reportExplicitAny]
+    _os.podman.ManifestSession,  # pyright: ignore[reportUnknownMemberType]
+)
+DELTA_PROFILES = cast(
+    dict[str, tuple[str, list[str], list[str]]],
+    _os.podman.DELTA_PROFILES,  # pyright:ignore [reportUnknownMemberType]
+)
+DEFAULT_DELTA_PROFILE = cast(str, _os.podman.DEFAULT_DELTA_PROFILE)  # pyright:ignore [reportUnknownMemberType]
+encode_delta = cast(Callable[[str, str, str, str], None], _os.podman.encode_delta)  # pyright:ignore [reportUnknownMemberType]
+decode_delta = cast(Callable[[str, str, str, str], None], _os.podman.decode_delta)  # pyright:ignore [reportUnknownMemberType]
+_save_image_to_file = cast(Callable[[str, str], None], _os.podman._save_image_to_file)  # pyright:ignore [reportUnknownMemberType, reportPrivateUsage]
+_save_image_layout = cast(Callable[[str, str], None], _os.podman._save_image_layout)  # pyright:ignore [reportUnknownMemberType, reportPrivateUsage]
+# (kind, variant, version, build, src, dst)
+TagInfo = tuple[str, str | None, str | None, str | None, str | None, str | None]
+classify_tags = cast(
+    Callable[[Iterable[str]], dict[str, TagInfo]],
+    _os.podman.classify_tags,  # pyright: ignore[reportUnknownMemberType]
+)
 hex_to_base62 = cast(Callable[[str], str], _os.podman.hex_to_base62)  # pyright:ignore [reportUnknownMemberType]
 pull = cast(Callable[[str], None], _os.podman.pull)  # pyright:ignore [reportUnknownMemberType]
 escape_label = cast(Callable[[str], str], _os.podman.escape_label)  # pyright: ignore[reportUnknownMemberType]
+create_image = cast(Callable[..., None], _os.podman.create_image)  # pyright: ignore[reportUnknownMemberType]
+write_image_layout = cast(Callable[..., None], _os.podman.write_image_layout)  # pyright: ignore[reportUnknownMemberType]
+encode_delta_map = cast(
+    Callable[[str, dict[str, list[str]], dict[str, int]], str],
+    _os.podman.encode_delta_map,  # pyright: ignore[reportUnknownMemberType]
+)
+MANIFEST_VERSION = cast(int, _os.podman.MANIFEST_VERSION)  # pyright: ignore[reportUnknownMemberType]
 image_digest = cast(Callable[[str, bool], str], _os.podman.image_digest)  # pyright:ignore [reportUnknownMemberType]
+image_ref = cast(Callable[[str], str], _os.podman.image_ref)  # pyright:ignore [reportUnknownMemberType]
 image_qualified_name = cast(Callable[[str], str], _os.podman.image_qualified_name)  # pyright:ignore [reportUnknownMemberType]
 base_images = cast(
     Callable[[str, dict[str, str] | None], Iterable[str]],
@@ -73,6 +120,15 @@ parse_containerfile = cast(
     Callable[[str | IO[str], dict[str, str] | None, bool], list[dict[str, Any]]],  # pyright: ignore[reportExplicitAny]
     _os.podman.parse_containerfile,  # pyright: ignore[reportUnknownMemberType]
 )
+Registry = cast(
+    Callable[[str], Any],  # pyright: ignore[reportExplicitAny]
+    _os.registry.Registry,  # pyright: ignore[reportUnknownMemberType]
+)
+ARCHITECTURE = cast(str, _os.registry.ARCHITECTURE)  # pyright: ignore[reportUnknownMemberType]
+RegistryError = cast(
+    type[Exception],
+    _os.registry.RegistryError,  # pyright: ignore[reportUnknownMemberType]
+)
 bytes_to_stdout = cast(
     Callable[[bytes], None],
     _os.console.bytes_to_stdout,  # pyright: ignore[reportUnknownMemberType]
@@ -81,6 +137,10 @@ bytes_to_stderr = cast(
     Callable[[bytes], None],
     _os.console.bytes_to_stderr,  # pyright: ignore[reportUnknownMemberType]
 )
+bytes_to_iec = cast(
+    Callable[[int], str],
+    _os.console.bytes_to_iec,  # pyright: ignore[reportUnknownMemberType]
+)
 
 IMAGE = cast(str, _os.IMAGE)
 REGISTRY = cast(str, _os.REGISTRY)
@@ -112,139 +172,356 @@ def base62_to_hex(base62_str: str) -> str:
     return hex_str
 
 
-def progress_bar[T](
-    iterable: list[T] | Iterable[T],
-    count: int | None = None,
-    prefix: str = "Progress: ",
-    out: TextIO = sys.stdout,
-    interval: int = 1,
-):
-    import os
+class _ProgressBar:
+    def __init__(self, count: int, prefix: str, out: TextIO, interval: int):
+        import os
 
-    if count is None:
-        count = len(iterable)  # pyright: ignore[reportArgumentType]
-
-    if not count:
-        return
-
-    no_progress = "CI" in os.environ or not out.isatty()
-    if no_progress and interval < 10:
-        interval = 10
+        self.count: int = count
+        self.prefix: str = prefix
+        self.out: TextIO = out
+        self.no_progress: bool = "CI" in os.environ or not out.isatty()
+        self.interval: int = 10 if self.no_progress and interval < 10 else interval
+        self.current: int = 0
+        self.last_update: float = 0.0
+        _ = signal.signal(signal.SIGWINCH, lambda _, _b: self.show())
+        self.show()
 
-    current = 0
+    def show(self):
+        import os
 
-    def show():
-        nonlocal current
-        if current > count:
-            current = count
+        if self.current > self.count:
+            self.current = self.count
 
-        if no_progress:
-            print(f"{prefix} {current}/{count}")
+        if self.no_progress:
+            print(f"{self.prefix} {self.current}/{self.count}")
             return
 
         size = os.get_terminal_size().columns
-        count_size = len(str(count))
-        size -= len(prefix) + 4 + (count_size * 2) + 1
+        count_size = len(str(self.count))
+        size -= len(self.prefix) + 4 + (count_size * 2) + 1
         if size < 2:
-            print(f"{current}/{count}")
+            print(f"{self.current}/{self.count}")
             return
 
-        x = int(size * current / count)
-        current_size = len(str(current))
+        x = int(size * self.current / self.count)
+        current_size = len(str(self.current))
         print(
-            f"{prefix}[{'█' * x}{'.' * (size - x)}] {' ' * (count_size - current_size)}{current}/{count}",
+            f"{self.prefix}[{'█' * x}{'.' * (size - x)}] {' ' * (count_size - current_size)}{self.current}/{self.count}",
             end="\r",
-            file=out,
+            file=self.out,
             flush=True,
         )
 
-    _ = signal.signal(signal.SIGWINCH, lambda _, _b: show())
-    show()
-    last_update = 0.0
+    def update(self, i: int):
+        now = time()
+        if now - self.last_update < self.interval and i < self.count - 1:
+            return
+
+        self.last_update = now
+        self.current = i + 1
+        self.show()
+
+    def close(self):
+        print(end="\n", file=self.out, flush=True)
+
+
+def _progress_bar[T](iterable: Iterable[T], bar: _ProgressBar) -> Iterator[T]:
     for i, item in enumerate(iterable):
         yield item
-        now = time()
-        if now - last_update < interval and i < count - 1:
-            continue
+        bar.update(i)
 
-        last_update = now
-        current = i + 1
-        show()
+    bar.close()
 
-    print(end="\n", file=out, flush=True)
 
+async def _async_progress_bar[T](
+    iterable: AsyncIterable[T], bar: _ProgressBar | None
+) -> AsyncIterator[T]:
+    if bar is None:
+        return
 
-_executor = ThreadPoolExecutor(max_workers=5)
-_image_sizes: dict[str, Future[int]] = {}
-_image_sizes_lock = threading.Lock()
+    i = 0
+    async for item in iterable:
+        yield item
+        bar.update(i)
+        i += 1
 
+    bar.close()
 
-def _image_size_cached(image: str) -> Future[int] | int:
-    future = _image_sizes.get(image)
-    if future is None:
-        with _image_sizes_lock:
-            # In case it was added after we locked
-            future = _image_sizes.get(image)
-            if future is None:
-                future = _executor.submit(
-                    cast(
-                        Callable[[str], int],
-                        _os.podman.image_size,  # pyright: ignore[reportUnknownMemberType]
-                    ),
-                    image,
-                )
-                _image_sizes[image] = future
 
-    return future
+@overload
+def progress_bar[T](
+    iterable: AsyncIterable[T],
+    count: int,
+    prefix: str = "Progress: ",
+    out: TextIO = sys.stdout,
+    interval: int = 1,
+) -> AsyncIterator[T]: ...
 
 
-def image_size_cached(image: str) -> int:
-    future = _image_size_cached(image)
-    if isinstance(future, Future):
-        return future.result()
+@overload
+def progress_bar[T](
+    iterable: list[T] | Iterable[T],
+    count: int | None = None,
+    prefix: str = "Progress: ",
+    out: TextIO = sys.stdout,
+    interval: int = 1,
+) -> Iterator[T]: ...
 
-    return future
+
+def progress_bar[T](
+    iterable: list[T] | Iterable[T] | AsyncIterable[T],
+    count: int | None = None,
+    prefix: str = "Progress: ",
+    out: TextIO = sys.stdout,
+    interval: int = 1,
+) -> Iterator[T] | AsyncIterator[T]:
+    if count is None:
+        count = len(iterable)  # pyright: ignore[reportArgumentType]
+
+    if isinstance(iterable, AsyncIterable):
+        if not count:
+            return _async_progress_bar(iterable, None)
+
+        return _async_progress_bar(iterable, _ProgressBar(count, prefix, out, interval))
+
+    if not count:
+        return iter(())
+
+    return _progress_bar(iterable, _ProgressBar(count, prefix, out, interval))
+
+
+REGISTRY_JOBS = int(os.environ.get("REGISTRY_JOBS", "8"))
+# Requests per second allowed against the registry, across all workers
+REGISTRY_RATE = float(os.environ.get("REGISTRY_RATE", "20"))
+REGISTRY_RETRIES = 5
+REGISTRY_MAX_BACKOFF = 30.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate: float = rate
+        self.burst: int = burst
+        self._tokens: float = float(burst)
+        self._updated: float = monotonic()
+        self._paused_until: float = 0.0
+        self._lock: threading.Lock = threading.Lock()
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+
+                else:
+                    self._tokens = min(
+                        self.burst, self._tokens + (now - self._updated) * self.rate
+                    )
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+
+                    wait = (1 - self._tokens) / self.rate
+
+            sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+class RegistryPool:
+    def __init__(self, jobs: int, rate: float, retries: int = REGISTRY_RETRIES):
+        self.retries: int = retries
+        self.bucket: TokenBucket = TokenBucket(rate, max(1, jobs))
+        self.metrics: Counter[str] = Counter()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max(1, jobs), thread_name_prefix="registry"
+        )
+        self._lock: threading.Lock = threading.Lock()
+        self._failed: threading.Event = threading.Event()
+
+    def _count(self, key: str, value: float = 1):
+        with self._lock:
+            self.metrics[key] += value  # pyright: ignore[reportArgumentType]
+
+    def _retry_delay(self, e: Exception, attempt: int) -> float | None:
+        if isinstance(e, (AssertionError, CancelledError)):
+            return None
+
+        if isinstance(e, subprocess.CalledProcessError) and e.returncode == 2:
+            # Image cannot be found
+            return None
+
+        status = cast(int | None, getattr(e, "status", None))
+        if status == 404:
+            return None
+
+        backoff = min(REGISTRY_MAX_BACKOFF, 2.0**attempt) * uniform(0.5, 1.0)
+        if status not in (429, 503):
+            return backoff
+
+        # Being rate limited applies to every worker, not just this one
+        delay = cast(float | None, getattr(e, "retry_after", None)) or backoff
+        self.bucket.pause(delay)
+        self._count("throttled")
+        self._count("throttled_seconds", delay)
+        return delay
+
+    def _run[T](self, fn: Callable[..., T], *args: Any) -> T:  # pyright: ignore[reportExplicitAny, reportAny]
+        for attempt in range(self.retries):
+            if self._failed.is_set():
+                self._count("cancelled")
+                raise CancelledError()
+
+            self._count("waited_seconds", self.bucket.acquire())
+            self._count("requests")
+            try:
+                result = fn(*args)
+
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    self._count("failed")
+                    raise
+
+                if attempt == self.retries - 1:
+                    # The registry is unusable, so anything still queued would
+                    # only fail the same way after its own retries
+                    self._count("failed")
+                    self.cancel()
+                    raise
+
+                self._count("retries")
+                sleep(delay)
+                continue
+
+            self._count("completed")
+            return result
+
+        raise AssertionError("unreachable")
+
+    def submit[T](self, fn: Callable[..., T], *args: Any) -> Future[T]:  # pyright: ignore[reportExplicitAny, reportAny]
+        self._count("submitted")
+        return self._executor.submit(self._run, fn, *args)
+
+    def cancel(self):
+        self._failed.set()
+
+    def report(self):
+        if not self.metrics["submitted"]:
+            return
+
+        print(
+            "Registry: "
+            + ", ".join(
+                f"{k.replace('_', ' ')}={v:.1f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in sorted(self.metrics.items())
+            ),
+            file=sys.stderr,
+        )
+
+
+registry_pool = RegistryPool(REGISTRY_JOBS, REGISTRY_RATE)
 
 
 DIGEST_CACHE_PATH = os.path.join(os.environ.get("TMPDIR", "/tmp"), "manifest_cache")
+DIGEST_CACHE_VERSION = 1
+# Each line is the layer estimate and the real ratio of an encoded delta. It
+# is kept next to the digest cache so the manifest cache actions persist it
+DELTA_HISTORY_PATH = os.environ.get(
+    "DELTA_HISTORY_PATH",
+    os.path.join(os.path.dirname(DIGEST_CACHE_PATH), "delta_history"),
+)
+DELTA_HISTORY_SIZE = 100
 _image_digests: dict[str, Future[str] | str] = {}
 _image_digests_lock = threading.Lock()
 _image_digests_write_lock = threading.Lock()
-if os.path.exists(DIGEST_CACHE_PATH):
-    with open(DIGEST_CACHE_PATH, "r") as f:
-        try:
-            data = json.load(f)  # pyright: ignore[reportAny]
-            assert isinstance(data, dict)
-            for image, digest in cast(dict[str, str], data).items():
-                assert isinstance(image, str)
-                assert isinstance(digest, str)
-                _image_digests[image] = digest
-
-        except Exception as e:
-            print(f"Failed to load digest cache: {e}", file=sys.stderr)
-            os.unlink(DIGEST_CACHE_PATH)
+_image_digests_pending: dict[str, str] = {}
+# Manifests behind a digest are immutable, so sizes never need invalidating
+_image_sizes: dict[str, int] = {}
+_image_sizes_pending: dict[str, int] = {}
+_image_size_futures: dict[str, Future[int]] = {}
+_delta_history_lock = threading.Lock()
+
+
+def _open_digest_cache(path: str) -> sqlite3.Connection:
+    legacy: dict[str, str] = {}
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            is_sqlite = f.read(16) in (b"SQLite format 3\x00", b"")
+
+        if not is_sqlite:
+            # Older versions stored the cache as a single JSON object
+            with open(path, "r") as f:
+                try:
+                    legacy = cast(dict[str, str], json.load(f))
+                    assert isinstance(legacy, dict)
+
+                except Exception as e:
+                    print(f"Failed to load digest cache: {e}", file=sys.stderr)
+                    legacy = {}
+
+            os.unlink(path)
+
+    try:
+        cache = sqlite3.connect(path, check_same_thread=False)
+        version = cast(int, cache.execute("PRAGMA user_version").fetchone()[0])
+
+    except sqlite3.DatabaseError as e:
+        print(f"Failed to load digest cache: {e}", file=sys.stderr)
+        os.unlink(path)
+        cache = sqlite3.connect(path, check_same_thread=False)
+        version = 0
+
+    if version != DIGEST_CACHE_VERSION:
+        _ = cache.executescript(f"""
+            DROP TABLE IF EXISTS digests;
+            CREATE TABLE digests (image TEXT PRIMARY KEY, digest TEXT NOT NULL);
+            PRAGMA user_version = {DIGEST_CACHE_VERSION};
+        """)
+
+    _ = cache.execute(
+        "CREATE TABLE IF NOT EXISTS sizes (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)"
+    )
+
+    with cache:
+        _ = cache.executemany(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?)",
+            [
+                (image, digest)
+                for image, digest in legacy.items()
+                if isinstance(image, str) and isinstance(digest, str)
+            ],
+        )
 
+    return cache
 
-def _remote_image_digest(image: str, skip_manifest: bool = False) -> str:
-    e: Exception | None = None
-    for attempt in range(10):
-        assert image_exists(image, True, skip_manifest), (
-            f"{image} does not exist on remote the server"
-        )
-        try:
-            digest = image_digest(image, True)
-            return digest
 
-        except Exception as ex:
-            e = ex
-            if isinstance(e, subprocess.CalledProcessError) and e.returncode == 2:
-                # Exit early, image cannot be found
-                break
+_digest_cache = _open_digest_cache(DIGEST_CACHE_PATH)
+_image_digests.update(
+    cast(
+        list[tuple[str, str]],
+        _digest_cache.execute("SELECT image, digest FROM digests").fetchall(),
+    )
+)
+_image_sizes.update(
+    cast(
+        list[tuple[str, int]],
+        _digest_cache.execute("SELECT digest, size FROM sizes").fetchall(),
+    )
+)
 
-            sleep(1.0 * (2**attempt))  # pyright: ignore[reportAny]
 
-    assert e is not None
-    raise e
+def _remote_image_digest(image: str, skip_manifest: bool = False) -> str:
+    # Retries are handled by registry_pool
+    assert image_exists(image, True, skip_manifest), (
+        f"{image} does not exist on remote the server"
+    )
+    return image_digest(image, True)
 
 
 def _image_digest_cached(image: str, skip_manifest: bool = False) -> Future[str] | str:
@@ -256,7 +533,9 @@ def _image_digest_cached(image: str, skip_manifest: bool = False) -> Future[str]
             # In case it was added after we locked
             future = _image_digests.get(image, None)
             if future is None:
-                future = _executor.submit(_remote_image_digest, image, skip_manifest)
+                future = registry_pool.submit(
+                    _remote_image_digest, image, skip_manifest
+                )
                 _image_digests[image] = future
 
     return future
@@ -264,20 +543,162 @@ def _image_digest_cached(image: str, skip_manifest: bool = False) -> Future[str]
 
 def _image_digests_write_cache(image: str, digest: str):
     global _image_digests
-    with _image_digests_write_lock:
-        image = image_qualified_name(image)
+    image = image_qualified_name(image)
+    with _image_digests_lock:
         if isinstance(_image_digests.get(image), str):
             return
 
         _image_digests[image] = digest
-        with open(DIGEST_CACHE_PATH, "w+") as f:
-            _ = f.seek(0)
-            json.dump(
-                {k: v for k, v in _image_digests.items() if isinstance(v, str)},
-                f,
+        _image_digests_pending[image] = digest
+
+    _digest_cache_flush()
+
+
+def _image_sizes_write_cache(digest: str, size: int):
+    with _image_digests_lock:
+        if digest in _image_sizes:
+            return
+
+        _image_sizes[digest] = size
+        _image_sizes_pending[digest] = size
+
+    _digest_cache_flush()
+
+
+def _digest_cache_flush():
+    # Whoever gets the write lock commits everything queued up by the callers
+    # waiting behind it, so concurrent writes share a single transaction
+    with _image_digests_write_lock:
+        with _image_digests_lock:
+            digests = list(_image_digests_pending.items())
+            sizes = list(_image_sizes_pending.items())
+            _image_digests_pending.clear()
+            _image_sizes_pending.clear()
+
+        if not digests and not sizes:
+            return
+
+        with _digest_cache:
+            _ = _digest_cache.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?)", digests
             )
-            _ = f.truncate()
-            _ = f.flush()
+            _ = _digest_cache.executemany(
+                "INSERT OR REPLACE INTO sizes VALUES (?, ?)", sizes
+            )
+
+
+def delta_history(path: str = DELTA_HISTORY_PATH) -> list[tuple[float, float]]:
+    # The estimated and real ratios of the most recent encodes
+    if not os.path.exists(path):
+        return []
+
+    with open(path, "r") as f:
+        lines = f.read().splitlines()
+
+    return [
+        cast(tuple[float, float], tuple(json.loads(line)))
+        for line in lines[-DELTA_HISTORY_SIZE:]
+        if line
+    ]
+
+
+def record_delta_ratio(estimate: float, ratio: float):
+    # Only the newest DELTA_HISTORY_SIZE rows are ever read, so the rest are
+    # dropped on every insert
+    with _delta_history_lock:
+        rows = [*delta_history()[1 - DELTA_HISTORY_SIZE :], (estimate, ratio)]
+        with open(f"{DELTA_HISTORY_PATH}.tmp", "w") as f:
+            _ = f.writelines(f"{json.dumps(x)}\n" for x in rows)
+
+        os.replace(f"{DELTA_HISTORY_PATH}.tmp", DELTA_HISTORY_PATH)
+
+
+def prune_digest_cache(repo: str, tags: Iterable[str]):
+    # Forget the digests of tags that no longer exist in repo, and the sizes of
+    # digests no cached tag points to anymore, so the cache does not grow
+    # without bound across runs
+    _digest_cache_flush()
+    live = {image_qualified_name(f"{repo}:{x}") for x in tags}
+    with _image_digests_write_lock:
+        with _image_digests_lock:
+            stale = [
+                image
+                for image, digest in _image_digests.items()
+                if isinstance(digest, str)
+                and image.startswith(f"{repo}:")
+                and image not in live
+            ]
+            for image in stale:
+                del _image_digests[image]
+
+            used = {x for x in _image_digests.values() if isinstance(x, str)}
+            unused = [x for x in _image_sizes if x not in used]
+            for digest in unused:
+                del _image_sizes[digest]
+
+        with _digest_cache:
+            _ = _digest_cache.executemany(
+                "DELETE FROM digests WHERE image = ?", [(x,) for x in stale]
+            )
+            _ = _digest_cache.executemany(
+                "DELETE FROM sizes WHERE digest = ?", [(x,) for x in unused]
+            )
+
+        if stale or unused:
+            _ = _digest_cache.execute("VACUUM")
+
+
+def _image_size(image: str) -> int:
+    digest = _image_digests.get(image)
+    if not isinstance(digest, str):
+        # One manifest request gives both, instead of checking that the tag
+        # exists, resolving the digest and then fetching the manifest
+        digest, size = cast(
+            Callable[[str], tuple[str, int]],
+            _os.podman.image_digest_and_size,  # pyright: ignore[reportUnknownMemberType]
+        )(image)
+        _image_digests_write_cache(image, digest)
+        _image_sizes_write_cache(digest, size)
+        return size
+
+    size = _image_sizes.get(digest)
+    if size is None:
+        registry, name, _, _ = image_name_parts(image)
+        # Look the size up by digest so it can never be for a different image
+        # if the tag moved since the digest was cached
+        size = cast(
+            Callable[[str], int],
+            _os.podman.image_size,  # pyright: ignore[reportUnknownMemberType]
+        )(image_name_from_parts(registry, name, None, digest))
+        _image_sizes_write_cache(digest, size)
+
+    return size
+
+
+def _image_size_cached(image: str) -> Future[int] | int:
+    image = image_qualified_name(image)
+    digest = _image_digests.get(image)
+    if isinstance(digest, str) and digest in _image_sizes:
+        return _image_sizes[digest]
+
+    future = _image_size_futures.get(image)
+    if future is None:
+        with _image_digests_lock:
+            # In case it was added after we locked
+            future = _image_size_futures.get(image)
+            if future is None:
+                future = registry_pool.submit(_image_size, image)
+                _image_size_futures[image] = future
+
+    return future
+
+
+def image_size_cached(image: str) -> int:
+    future = _image_size_cached(image)
+    if isinstance(future, Future):
+        return future.result()
+
+    return future
 
 
 def image_digest_cached(image: str, skip_manifest: bool = False) -> str:
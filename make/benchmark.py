@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import resource
+import shutil
+
+from hashlib import sha256
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
+from time import time
+from argparse import ArgumentParser
+from argparse import Namespace
+from typing import Any
+from typing import Callable
+from typing import cast
+
+from . import ci_log
+from . import pull
+from . import encode_delta
+from . import decode_delta
+from . import DELTA_PROFILES
+from . import _save_image_to_file  # pyright: ignore[reportPrivateUsage]
+from . import _save_image_layout  # pyright: ignore[reportPrivateUsage]
+from . import REPO
+from . import bytes_to_iec
+
+kwds: dict[str, str] = {
+    "help": "Compare delta encoder profiles against real tag pairs",
+}
+
+
+def register(parser: ArgumentParser):
+    _ = parser.add_argument(
+        "target",
+        action="extend",
+        nargs="+",
+        type=str,
+        metavar="TAG",
+        help="Pairs of tags to generate deltas between, old tag first",
+    )
+    _ = parser.add_argument(
+        "--profile",
+        action="append",
+        choices=list(DELTA_PROFILES.keys()),
+        help="Profile to benchmark, can be repeated. Defaults to all of them",
+    )
+    _ = parser.add_argument(
+        "--no-pull",
+        action="store_false",
+        dest="pull",
+        help="Do not pull images from the remote repository",
+    )
+    _ = parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output the results as JSON",
+    )
+
+
+def command(args: Namespace):
+    targets = cast(list[str], args.target)
+    if len(targets) % 2:
+        print("Tags must be given in pairs")
+        sys.exit(1)
+
+    profiles = cast(list[str] | None, args.profile) or list(DELTA_PROFILES.keys())
+    results: list[dict[str, str | int | float | bool]] = []
+    for a, b in zip(targets[::2], targets[1::2]):
+        if cast(bool, args.pull):
+            ci_log(f"::group::pull {a} and {b}")
+            pull(f"{REPO}:{a}")
+            pull(f"{REPO}:{b}")
+            ci_log("::endgroup::")
+
+        ci_log(f"::group::benchmark {a} and {b}")
+        results += benchmark(f"{REPO}:{a}", f"{REPO}:{b}", profiles)
+        ci_log("::endgroup::")
+
+    if cast(bool, args.json):
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{'pair':<45} {'profile':<16} {'size':>10} {'ratio':>6} {'encode':>8} {'decode':>8} {'enc rss':>10} {'dec rss':>10}"
+    )
+    for result in results:
+        pair = f"{result['old']}..{result['new']}"
+        if len(pair) > 45:
+            pair = f"...{pair[-42:]}"
+
+        print(
+            " ".join(
+                [
+                    f"{pair:<45}",
+                    f"{result['profile']:<16}",
+                    f"{bytes_to_iec(cast(int, result['size'])):>10}",
+                    f"{cast(float, result['ratio']):>6.1%}",
+                    f"{cast(float, result['encode_time']):>7.1f}s",
+                    f"{cast(float, result['decode_time']):>7.1f}s",
+                    f"{bytes_to_iec(cast(int, result['encode_rss'])):>10}",
+                    f"{bytes_to_iec(cast(int, result['decode_rss'])):>10}",
+                    "" if result["ok"] else "MISMATCH",
+                ]
+            )
+        )
+
+
+def _measure(fn: Callable[..., None], *args: str) -> tuple[float, int]:
+    start = time()
+    fn(*args)
+    # Only the largest single child is reported, which for pipelines is the
+    # stage that needs the most memory
+    return time() - start, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def _run(fn: Callable[..., None], *args: str) -> tuple[float, int]:
+    # Every measurement gets a fresh process so that the peak RSS of its
+    # children is not mixed up with earlier runs
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("fork")) as pool:
+        return pool.submit(_measure, fn, *args).result()
+
+
+def _size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _digest(path: str) -> str:
+    m = sha256()
+    paths = (
+        [path]
+        if not os.path.isdir(path)
+        else sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    )
+    for file in paths:
+        m.update(os.path.relpath(file, path).encode("utf-8"))
+        with open(file, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                m.update(chunk)
+
+    return m.hexdigest()
+
+
+def benchmark(
+    imageA: str, imageB: str, profiles: list[str]
+) -> list[dict[str, str | int | float | bool]]:
+    results: list[dict[str, str | int | float | bool]] = []
+    with TemporaryDirectory() as tmpdir:
+        sources: dict[bool, tuple[str, str, str]] = {}
+        for profile in profiles:
+            patch_format = DELTA_PROFILES[profile][0]
+            layout = patch_format == "layers+xdelta3+zstd"
+            if layout not in sources:
+                save = _save_image_layout if layout else _save_image_to_file
+                ext = "" if layout else ".oci"
+                old_path = os.path.join(tmpdir, f"old{ext}")
+                new_path = os.path.join(tmpdir, f"new{ext}")
+                save(imageA, old_path)
+                save(imageB, new_path)
+                sources[layout] = (old_path, new_path, _digest(new_path))
+
+            old_path, new_path, new_digest = sources[layout]
+            diff_path = os.path.join(tmpdir, f"{profile}.diff")
+            out_path = os.path.join(tmpdir, f"{profile}.out")
+            print(f"Encoding with {profile}")
+            encode_time, encode_rss = _run(
+                encode_delta, profile, old_path, new_path, diff_path
+            )
+            print(f"Decoding with {profile}")
+            decode_time, decode_rss = _run(
+                decode_delta, patch_format, old_path, diff_path, out_path
+            )
+            size = _size(diff_path)
+            results.append(
+                {
+                    "old": imageA,
+                    "new": imageB,
+                    "profile": profile,
+                    "format": patch_format,
+                    "size": size,
+                    "ratio": size / _size(new_path),
+                    "encode_time": encode_time,
+                    "decode_time": decode_time,
+                    "encode_rss": encode_rss,
+                    "decode_rss": decode_rss,
+                    "ok": _digest(out_path) == new_digest,
+                }
+            )
+            for path in (diff_path, out_path):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+
+                elif os.path.exists(path):
+                    os.unlink(path)
+
+    return results
+
+
+if __name__ == "__main__":
+    kwds["description"] = kwds["help"]
+    del kwds["help"]
+    parser = ArgumentParser(
+        **cast(  # pyright: ignore[reportAny]
+            dict[str, Any],  # pyright: ignore[reportExplicitAny]
+            kwds,
+        ),
+    )
+    register(parser)
+    args = parser.parse_args()
+    command(args)
@@ -3,6 +3,11 @@ import json
 import os
 import sys
 import shutil
+import threading
+
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 
 from argparse import ArgumentParser
 from argparse import Namespace
@@ -16,6 +21,9 @@ from . import execute_pipe
 from . import chronic
 from . import _execute  # pyright: ignore[reportPrivateUsage]
 from . import _osDir  # pyright: ignore[reportPrivateUsage]
+from . import Registry
+from . import RegistryError
+from . import ARCHITECTURE
 from . import REPO
 from . import IMAGE
 
@@ -32,6 +40,126 @@ def register(parser: ArgumentParser):
     )
 
 
+class _FakeRegistry(BaseHTTPRequestHandler):
+    # A registry that requires a token, rate limits the first manifest
+    # request, and redirects blobs to a CDN that rejects the token
+    config: bytes = json.dumps(
+        {"architecture": ARCHITECTURE, "config": {"Labels": {"check": "ok"}}}
+    ).encode("utf-8")
+    config_digest: str = f"sha256:{sha256(config).hexdigest()}"
+    manifest: bytes = json.dumps(
+        {
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {"digest": config_digest},
+            "layers": [],
+        }
+    ).encode("utf-8")
+    manifest_digest: str = f"sha256:{sha256(manifest).hexdigest()}"
+    index: bytes = json.dumps(
+        {
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": [
+                {
+                    "digest": "sha256:0",
+                    "platform": {"os": "linux", "architecture": "other"},
+                },
+                {
+                    "digest": manifest_digest,
+                    "platform": {"os": "linux", "architecture": ARCHITECTURE},
+                },
+            ],
+        }
+    ).encode("utf-8")
+    limited: bool = False
+
+    def _reply(
+        self, status: int, body: bytes = b"", headers: dict[str, str] | None = None
+    ):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        _ = self.wfile.write(body)
+
+    def do_GET(self):
+        host = f"http://{self.headers['Host']}"
+        if self.path.startswith("/token?"):
+            self._reply(200, json.dumps({"token": "check"}).encode("utf-8"))
+            return
+
+        if self.path.startswith("/cdn/"):
+            if "Authorization" in self.headers:
+                self._reply(400)
+
+            else:
+                self._reply(200, self.config)
+
+            return
+
+        if self.headers.get("Authorization") != "Bearer check":
+            self._reply(
+                401,
+                headers={
+                    "WWW-Authenticate": f'Bearer realm="{host}/token",service="check"'
+                },
+            )
+            return
+
+        if self.path == "/v2/check/manifests/latest":
+            if not _FakeRegistry.limited:
+                _FakeRegistry.limited = True
+                self._reply(429, headers={"Retry-After": "7"})
+
+            else:
+                self._reply(200, self.index)
+
+        elif self.path == f"/v2/check/manifests/{self.manifest_digest}":
+            self._reply(200, self.manifest)
+
+        elif self.path == f"/v2/check/blobs/{self.config_digest}":
+            self._reply(307, headers={"Location": f"{host}/cdn/{self.config_digest}"})
+
+        else:
+            self._reply(404)
+
+    def log_message(self, format: str, *args: object):
+        pass
+
+
+def _check_registry() -> bool:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeRegistry)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    registry = Registry(f"127.0.0.1:{server.server_address[1]}")
+    try:
+        try:
+            _ = registry.inspect("check", "latest")
+            print(" Failed: Registry did not raise on 429")
+            return False
+
+        except RegistryError as e:
+            if getattr(e, "retry_after", None) != 7:
+                print(f" Failed: Retry-After was not parsed from {e}")
+                return False
+
+        info = cast(dict[str, object], registry.inspect("check", "latest"))
+        if info.get("Labels") != {"check": "ok"}:
+            print(f" Failed: Registry.inspect returned {info}")
+            return False
+
+        return True
+
+    except Exception as e:
+        print(f" Failed: Registry.inspect raised {e}")
+        return False
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def command(args: Namespace):
     failed = False
     fix = cast(bool, args.fix)
@@ -74,6 +202,7 @@ def command(args: Namespace):
     )
     failed = failed or not _assert_name(f"{IMAGE}:latest", f"{REPO}:latest")
     failed = failed or not _assert_name(IMAGE, REPO)
+    failed = failed or not _check_registry()
     if shutil.which("niri") is not None:
         print("[check] Checking niri config", file=sys.stderr)
         cmd = shlex.join(
@@ -1,7 +1,12 @@
+import os
 import sys
 import importlib
+import threading
 
 from subprocess import CalledProcessError
+from collections import Counter
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from argparse import Namespace
 from collections.abc import Iterable
@@ -14,16 +19,26 @@ from . import hex_to_base62
 from . import image_digest
 from . import podman
 from . import create_delta
+from . import delta_is_hopeless
+from . import delta_history
+from . import estimate_delta_ratio
+from . import record_delta_ratio
+from . import ArchiveCache
+from . import DELTA_PROFILES
+from . import DEFAULT_DELTA_PROFILE
 from . import _image_digests_write_cache  # pyright: ignore[reportPrivateUsage]
 from . import REPO
 from . import __name__ as modulename
 
 from .pull import pull
 
+get_deltas_module = importlib.import_module(f"{modulename}.get-deltas", modulename)
 get_deltas = cast(
-    Callable[[str, bool], Iterable[tuple[str, str, str]]],
-    importlib.import_module(f"{modulename}.get-deltas", modulename).get_deltas,
+    Callable[[str, bool, str, int, object], Iterable[tuple[str, str, str]]],
+    get_deltas_module.get_deltas,
 )
+STRATEGIES = cast(list[str], get_deltas_module.STRATEGIES)
+tag_snapshot = cast(Callable[[], object], get_deltas_module.tag_snapshot)
 
 kwds: dict[str, str] = {
     "help": "Generate deltas",
@@ -66,6 +81,53 @@ def register(parser: ArgumentParser):
         action="store_true",
         help="Generate all deltas, not just the missing ones",
     )
+    _ = parser.add_argument(
+        "--strategy",
+        choices=STRATEGIES,
+        default=STRATEGIES[0],
+        help="How to pick pairs when --explicit is not set, see make.py get-deltas",
+    )
+    _ = parser.add_argument(
+        "--budget",
+        type=int,
+        default=0,
+        help="The maximum number of deltas to generate per variant, most useful first. 0 for no limit",
+    )
+    _ = parser.add_argument(
+        "--jobs",
+        type=int,
+        default=2,
+        help="How many deltas to encode at the same time",
+    )
+    _ = parser.add_argument(
+        "--io-jobs",
+        type=int,
+        default=3,
+        help="How many images to pull or push at the same time",
+    )
+    _ = parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=None,
+        metavar="GIB",
+        help="Size of the cache for saved image archives shared between pairs, 0 to disable it. Defaults to 10, or 0 with --explicit",
+    )
+    _ = parser.add_argument(
+        "--profile",
+        choices=list(DELTA_PROFILES.keys()),
+        default=DEFAULT_DELTA_PROFILE,
+        help="The encoder profile to generate deltas with, see make.py benchmark",
+    )
+    _ = parser.add_argument(
+        "--skip-hopeless",
+        action="store_true",
+        help="Create placeholders without encoding for pairs that past deltas predict to be too large",
+    )
+    _ = parser.add_argument(
+        "--placeholder",
+        action="store_true",
+        help="With --explicit, create a placeholder without pulling or encoding, for pairs get-deltas --skip-hopeless predicts to be too large",
+    )
 
 
 def command(args: Namespace):
@@ -73,27 +135,209 @@ def command(args: Namespace):
     pull = cast(bool, args.pull)
     clean = cast(bool, args.clean)
     targets = cast(list[str], args.target)
-    if cast(bool, args.explicit):
+    explicit = cast(bool, args.explicit)
+    cache_size = cast(int | None, args.cache_size)
+    if cache_size is None:
+        # A single pair never reuses an archive, so caching only costs disk
+        cache_size = 0 if explicit else 10
+
+    profile = cast(str, args.profile)
+    cache = (
+        ArchiveCache(
+            os.path.join(os.environ.get("TMPDIR", "/tmp"), "archive_cache"),
+            cache_size * 1024**3,
+        )
+        if cache_size
+        else None
+    )
+    if explicit:
         if len(targets) != 2:
             print("When --explicit is set, you must specify two explicit tags")
             sys.exit(1)
 
         imageA, imageB = targets
-        delta(imageA, imageB, pull, push, clean)
+        delta(
+            imageA,
+            imageB,
+            pull,
+            push,
+            clean,
+            cache=cache,
+            profile=profile,
+            skip_encode=cast(bool, args.placeholder),
+        )
         return
 
     missing_only = not cast(bool, args.force)
-    for target in targets:
-        for a, b, t in get_deltas(target, missing_only):
-            delta(a, b, pull, push, clean, imageD=f"{REPO}:{t}")
+    snapshot = tag_snapshot()
+    delta_all(
+        [
+            (a, b, f"{REPO}:{t}")
+            for target in targets
+            for a, b, t in get_deltas(
+                target,
+                missing_only,
+                cast(str, args.strategy),
+                cast(int, args.budget),
+                snapshot,
+            )
+        ],
+        pull,
+        push,
+        clean,
+        jobs=cast(int, args.jobs),
+        io_jobs=cast(int, args.io_jobs),
+        cache=cache,
+        profile=profile,
+        skip_hopeless=cast(bool, args.skip_hopeless),
+    )
+
+
+def delta_all(
+    pairs: list[tuple[str, str, str]],
+    allow_pull: bool,
+    push: bool,
+    clean: bool,
+    jobs: int = 2,
+    io_jobs: int = 3,
+    cache: object | None = None,
+    profile: str = DEFAULT_DELTA_PROFILE,
+    skip_hopeless: bool = False,
+):
+    # Encoding is CPU bound while pulling and pushing is network bound, so
+    # each gets its own pool. Pulls are shared between pairs, prefetched a
+    # pair ahead of the encoders, and pushes happen while the next pair is
+    # being encoded. With skip_hopeless, pairs that are predicted to be too
+    # large are never pulled, they just get a placeholder, and every pair that
+    # is encoded calibrates the prediction.
+    # This is only used for local batch runs, CI runs every pair as its own
+    # --explicit job through delta() instead, so it gets none of the overlap.
+    pulls: dict[str, Future[None]] = {}
+    pushes: list[Future[None]] = []
+    lock = threading.Lock()
+    with (
+        ThreadPoolExecutor(max_workers=max(1, io_jobs)) as io,
+        ThreadPoolExecutor(max_workers=max(1, jobs)) as cpu,
+    ):
+        estimates = (
+            list(
+                io.map(
+                    lambda x: estimate_delta_ratio(f"{REPO}:{x[0]}", f"{REPO}:{x[1]}"),
+                    pairs,
+                )
+            )
+            if skip_hopeless
+            else [None] * len(pairs)
+        )
+        history = delta_history() if skip_hopeless else []
+        hopeless = [delta_is_hopeless(x, history) for x in estimates]
+        refs = Counter(
+            tag
+            for i, (a, b, _) in enumerate(pairs)
+            if not hopeless[i]
+            for tag in (a, b)
+        )
+
+        def _pull(tag: str) -> Future[None] | None:
+            if not allow_pull:
+                return None
+
+            with lock:
+                if tag not in pulls:
+                    pulls[tag] = io.submit(pull, f"{REPO}:{tag}")
+
+                return pulls[tag]
+
+        def _release(*tags: str):
+            with lock:
+                unused: list[str] = []
+                for tag in tags:
+                    refs[tag] -= 1
+                    if not refs[tag]:
+                        unused.append(tag)
+
+            if clean and unused:
+                podman("rmi", *[f"{REPO}:{x}" for x in unused])
+
+        def _push(imageD: str):
+            _push_delta(imageD)
+            if clean:
+                podman("rmi", imageD)
+
+        def _encode(i: int):
+            a, b, imageD = pairs[i]
+            ahead = i + jobs < len(pairs) and not hopeless[i + jobs]
+            for tag in pairs[i + jobs][:2] if ahead else ():
+                _ = _pull(tag)
+
+            if hopeless[i]:
+                print(
+                    f"Generating placeholder delta between {a} and {b}, predicted to be too large"
+                )
+                _ = create_delta(
+                    f"{REPO}:{a}", f"{REPO}:{b}", imageD, allow_pull, skip_encode=True
+                )
+                if push:
+                    with lock:
+                        pushes.append(io.submit(_push, imageD))
+
+                return
+
+            for tag in (a, b):
+                future = _pull(tag)
+                if future is not None:
+                    future.result()
+
+            estimate = estimates[i]
+            try:
+                print(f"Generating delta between {a} and {b}")
+                _ = create_delta(
+                    f"{REPO}:{a}",
+                    f"{REPO}:{b}",
+                    imageD,
+                    allow_pull,
+                    cache=cache,
+                    profile=profile,
+                    onratio=None
+                    if estimate is None
+                    else lambda x: record_delta_ratio(estimate, x),
+                )
+
+            finally:
+                _release(a, b)
+
+            if push:
+                with lock:
+                    pushes.append(io.submit(_push, imageD))
+
+        try:
+            for future in [cpu.submit(_encode, i) for i in range(len(pairs))]:
+                future.result()
+
+        except BaseException:
+            cpu.shutdown(cancel_futures=True)
+            raise
+
+        for future in pushes:
+            future.result()
 
 
 def delta(
-    a: str, b: str, allow_pull: bool, push: bool, clean: bool, imageD: str | None = None
+    a: str,
+    b: str,
+    allow_pull: bool,
+    push: bool,
+    clean: bool,
+    imageD: str | None = None,
+    cache: object | None = None,
+    profile: str = DEFAULT_DELTA_PROFILE,
+    skip_encode: bool = False,
 ):
     imageA = f"{REPO}:{a}"
     imageB = f"{REPO}:{b}"
-    if allow_pull:
+    # Placeholders never need the images themselves
+    pulled = allow_pull and not skip_encode
+    if pulled:
         ci_log(f"::group::pull {imageA}")
         pull(imageA)
         ci_log("::endgroup::")
@@ -102,39 +346,56 @@ def delta(
         ci_log("::endgroup::")
 
     if imageD is None:
-        digestA = hex_to_base62(image_digest(imageA, False))
-        digestB = hex_to_base62(image_digest(imageB, False))
+        digestA = hex_to_base62(image_digest(imageA, skip_encode))
+        digestB = hex_to_base62(image_digest(imageB, skip_encode))
         assert digestA != digestB, "There is nothing to diff"
         imageD = f"{REPO}:_diff-{digestA}-{digestB}"
 
+    # Every real encode calibrates the prediction for later runs
+    estimate = None if skip_encode else estimate_delta_ratio(imageA, imageB)
     ci_log(f"::group::delta {a} and {b}")
-    _ = create_delta(imageA, imageB, imageD, allow_pull)
+    _ = create_delta(
+        imageA,
+        imageB,
+        imageD,
+        allow_pull,
+        cache=cache,
+        profile=profile,
+        skip_encode=skip_encode,
+        onratio=None if estimate is None else lambda x: record_delta_ratio(estimate, x),
+    )
     ci_log("::endgroup::")
     if push:
         ci_log("::group::push")
-        tries = 3
-        while tries:
-            try:
-                podman("push", imageD)
-                break
-
-            except CalledProcessError:
-                tries -= 1
-
+        _push_delta(imageD)
         ci_log("::endgroup::")
-        _image_digests_write_cache(imageD, image_digest(imageD, False))
 
     if not clean:
         return
 
     ci_log("::group::clean")
-    podman("rmi", imageA, imageB)
+    if not skip_encode:
+        podman("rmi", imageA, imageB)
+
     if push:
         podman("rmi", imageD)
 
     ci_log("::endgroup::")
 
 
+def _push_delta(imageD: str):
+    tries = 3
+    while tries:
+        try:
+            podman("push", imageD)
+            break
+
+        except CalledProcessError:
+            tries -= 1
+
+    _image_digests_write_cache(imageD, image_digest(imageD, False))
+
+
 if __name__ == "__main__":
     kwds["description"] = kwds["help"]
     del kwds["help"]
@@ -0,0 +1,228 @@
+import json
+import subprocess
+
+from argparse import ArgumentParser
+from argparse import Namespace
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures import as_completed
+from typing import Any
+from typing import cast
+
+from . import image_tags
+from . import hex_to_base62
+from . import classify_tags
+from . import progress_bar
+from . import registry_pool
+from . import bytes_to_iec
+from . import ManifestSession
+from . import _image_size_cached  # pyright: ignore[reportPrivateUsage]
+from . import _image_digest_cached  # pyright: ignore[reportPrivateUsage]
+from . import _image_digests_write_cache  # pyright: ignore[reportPrivateUsage]
+from . import IMAGE
+from . import REPO
+
+
+OWNER, PACKAGE = IMAGE.split("/", 1)
+PACKAGE_API = f"/users/{OWNER}/packages/container/{PACKAGE}/versions"
+
+kwds: dict[str, str] = {
+    "help": "Remove delta and build tags that no route in the manifest uses",
+}
+
+
+def register(parser: ArgumentParser):
+    _ = parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report what would be removed",
+    )
+    _ = parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Output the images to remove as JSON",
+    )
+
+
+def command(args: Namespace):
+    dry_run = cast(bool, args.dry_run)
+    output_json = cast(bool, args.json)
+    removable = collect()
+    # Queue every lookup before waiting on any of them
+    pending = {
+        digest: _image_size_cached(f"{REPO}:{tags[0]}")
+        for digest, tags in removable.items()
+    }
+    sizes = {
+        digest: size.result() if isinstance(size, Future) else size
+        for digest, size in pending.items()
+    }
+    if output_json:
+        print(
+            json.dumps(
+                [
+                    {"digest": digest, "tags": tags, "size": sizes[digest]}
+                    for digest, tags in removable.items()
+                ]
+            )
+        )
+
+    else:
+        for digest, tags in removable.items():
+            print(f"{digest} {bytes_to_iec(sizes[digest])}: {' '.join(tags)}")
+
+        print(
+            f"{sum(len(x) for x in removable.values())} tags in {len(removable)} images, {bytes_to_iec(sum(sizes.values()))} reclaimable"
+        )
+
+    if dry_run:
+        return
+
+    # ghcr.io does not support deleting manifests through the registry API,
+    # so versions are deleted through the GitHub Packages API instead
+    versions = package_versions()
+    missing = [x for x in removable.keys() if x not in versions]
+    if missing:
+        print(f"{len(missing)} images have no package version, skipping them")
+
+    for digest in progress_bar(
+        [x for x in removable.keys() if x in versions], prefix="Removing images: "
+    ):
+        _ = subprocess.check_call(
+            ["gh", "api", "--method", "DELETE", f"{PACKAGE_API}/{versions[digest]}"]
+        )
+
+    registry_pool.report()
+
+
+def package_versions() -> dict[str, str]:
+    # Maps the digest of every version of the package to its id
+    output = subprocess.check_output(
+        [
+            "gh",
+            "api",
+            "--paginate",
+            PACKAGE_API,
+            "--jq",
+            '.[] | "\\(.name) \\(.id)"',
+        ],
+        text=True,
+    )
+    versions: dict[str, str] = {}
+    for line in output.splitlines():
+        digest, _, version = line.partition(" ")
+        versions[digest] = version
+
+    return versions
+
+
+def collect() -> dict[str, list[str]]:
+    session = ManifestSession(f"{REPO}:_manifest")
+    assert cast(bool, session.refresh()), "Failed to pull the manifest"
+    # Tags the manifest knew about when it was generated, anything else is
+    # newer than the manifest and has not had a chance to be routed yet
+    digests = {
+        tag: cast(str, session.digest(tag)) for tag in cast(list[str], session.tags())
+    }
+    known = {hex_to_base62(x) for x in digests.values()}
+    targets = cast(list[str], session.targets())
+    assert targets, "The manifest has no routes"
+    retained: set[str] = set()
+    nodes: set[str] = set()
+    for target in targets:
+        nodes.add(target)
+        for path in cast(dict[str, list[str]], session.delta_map(target)).values():
+            retained.update(path)
+            for tag in path:
+                nodes.update(tag[6:].split("-"))
+
+    print("Getting all tags...")
+    all_tags = image_tags(REPO, True)
+    assert all_tags, "No tags found"
+    table = classify_tags(all_tags)
+    # Delta endpoints come from their tag names, so only tags pushed since the
+    # manifest was generated need their digest looked up here
+    digests.update(
+        _digests(
+            [
+                tag
+                for tag, (kind, *_) in table.items()
+                if kind not in ("diff", "manifest") and tag not in digests
+            ]
+        )
+    )
+    current = {
+        hex_to_base62(digests[tag])
+        for tag, (kind, *_) in table.items()
+        if kind in ("build", "version", "variant")
+    }
+    by_digest: defaultdict[str, list[str]] = defaultdict(list)
+    pinned: set[str] = set()
+    for tag, (kind, *_) in table.items():
+        if kind in ("diff", "manifest"):
+            continue
+
+        digest = digests[tag]
+        b62 = hex_to_base62(digest)
+        by_digest[digest].append(tag)
+        if kind != "build" or b62 in nodes or b62 not in known:
+            pinned.add(digest)
+
+    # Deltas between two builds that are kept stay, even when no route uses
+    # them, as get-deltas would only generate them again
+    kept = {hex_to_base62(x) for x in pinned}
+    removable_diffs = [
+        tag
+        for tag, (kind, *_, src, dst) in table.items()
+        if kind == "diff"
+        and tag not in retained
+        and not (dst in current and dst not in known)
+        and not (src in kept and dst in kept)
+    ]
+    for tag, digest in _digests(removable_diffs).items():
+        by_digest[digest].append(tag)
+
+    # Removing an image removes every tag pointing to it, so only remove the
+    # ones where none of the tags are still used
+    return {
+        digest: sorted(tags)
+        for digest, tags in by_digest.items()
+        if digest not in pinned
+    }
+
+
+def _digests(tags: list[str]) -> dict[str, str]:
+    digests: dict[str, str] = {}
+    futures: dict[Future[str], str] = {}
+    for tag in tags:
+        image = f"{REPO}:{tag}"
+        digest = _image_digest_cached(image, skip_manifest=True)
+        if not isinstance(digest, Future):
+            digests[tag] = digest
+            continue
+
+        digest.add_done_callback(
+            lambda x, image=image: _image_digests_write_cache(image, x.result())
+        )
+        futures[digest] = tag
+
+    for future in progress_bar(
+        as_completed(futures), count=len(futures), prefix="Getting digests: "
+    ):
+        digests[futures[future]] = future.result()
+
+    return digests
+
+
+if __name__ == "__main__":
+    kwds["description"] = kwds["help"]
+    del kwds["help"]
+    parser = ArgumentParser(
+        **cast(  # pyright: ignore[reportAny]
+            dict[str, Any],  # pyright: ignore[reportExplicitAny]
+            kwds,
+        ),
+    )
+    register(parser)
+    args = parser.parse_args()
+    command(args)
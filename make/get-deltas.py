@@ -1,5 +1,7 @@
 import json
 
+from datetime import date
+from datetime import datetime
 from argparse import ArgumentParser
 from argparse import Namespace
 from typing import Any
@@ -8,12 +10,60 @@ from collections.abc import Iterable
 
 from . import image_tags
 from . import hex_to_base62
+from . import classify_tags
 from . import image_digest_cached
+from . import registry_pool
+from . import delta_history
+from . import delta_is_hopeless
+from . import estimate_delta_ratio
 from . import REPO
 
 kwds: dict[str, str] = {
     "help": "Get deltas",
 }
+STRATEGIES = ["adaptive", "adjacent"]
+# How many of the latest builds get a delta straight to the newest build
+RECENT_BUILDS = 7
+# How many weeks back the weekly anchors get a delta straight to the newest
+ANCHOR_WEEKS = 12
+
+
+class TagSnapshot:
+    def __init__(self, tags: list[str]):
+        self.tags: list[str] = tags
+        self.variants: dict[str, list[str]] = {}
+        self.diffs: set[str] = set()
+        self.diff_sources: dict[str, set[str]] = {}
+        self.diff_targets: dict[str, set[str]] = {}
+        for tag, (kind, variant, _version, _build, src, dst) in classify_tags(
+            tags
+        ).items():
+            if kind == "diff":
+                assert src and dst
+                self.diffs.add(tag)
+                self.diff_sources.setdefault(src, set()).add(dst)
+                self.diff_targets.setdefault(dst, set()).add(src)
+
+            elif kind in ("build", "version"):
+                assert variant
+                self.variants.setdefault(variant, []).append(tag)
+
+        for variant_tags in self.variants.values():
+            variant_tags.sort()
+
+    def variant(self, target: str) -> list[str]:
+        return [
+            x
+            for x in self.variants.get(target, [])
+            if target == "rootfs" or len(x[len(target) + 1 :]) > 10
+        ]
+
+    def has_diff(self, src: str, dst: str) -> bool:
+        return dst in self.diff_sources.get(src, ())
+
+
+def tag_snapshot() -> TagSnapshot:
+    return TagSnapshot(image_tags(REPO, True))
 
 
 def register(parser: ArgumentParser):
@@ -28,6 +78,23 @@ def register(parser: ArgumentParser):
     _ = parser.add_argument(
         "--missing", action="store_true", help="Only return deltas that are missing"
     )
+    _ = parser.add_argument(
+        "--strategy",
+        choices=STRATEGIES,
+        default=STRATEGIES[0],
+        help="How to pick pairs, adaptive prefers the deltas clients are most likely to use, adjacent pairs every build with the next three",
+    )
+    _ = parser.add_argument(
+        "--budget",
+        type=int,
+        default=0,
+        help="The maximum number of deltas to return per variant, most useful first. 0 for no limit",
+    )
+    _ = parser.add_argument(
+        "--skip-hopeless",
+        action="store_true",
+        help="Mark pairs that past deltas predict to be too large, so only a placeholder is created for them",
+    )
     _ = parser.add_argument(
         "--json",
         action="store_true",
@@ -39,11 +106,29 @@ def command(args: Namespace):
     missing_only = cast(bool, args.missing)
     output_json = cast(bool, args.json)
     targets = cast(list[str], args.target)
-    tags = [
+    snapshot = tag_snapshot()
+    tags: list[dict[str, str | bool]] = [
         {"a": a, "b": b, "tag": tag}
         for target in targets
-        for a, b, tag in get_deltas(target, missing_only=missing_only)
+        for a, b, tag in get_deltas(
+            target,
+            missing_only=missing_only,
+            strategy=cast(str, args.strategy),
+            budget=cast(int, args.budget),
+            snapshot=snapshot,
+        )
     ]
+    if cast(bool, args.skip_hopeless):
+        history = delta_history()
+        estimates = [
+            registry_pool.submit(
+                estimate_delta_ratio, f"{REPO}:{item['a']}", f"{REPO}:{item['b']}"
+            )
+            for item in tags
+        ]
+        for item, estimate in zip(tags, estimates):
+            item["hopeless"] = delta_is_hopeless(estimate.result(), history)
+
     if output_json:
         print(json.dumps(tags))
         return
@@ -52,40 +137,94 @@ def command(args: Namespace):
         print(item["tag"])
 
 
-def get_deltas(
-    target: str, missing_only: bool = False
-) -> Iterable[tuple[str, str, str]]:
-    tags = image_tags(REPO, True)
-    target_tags = [
-        x
-        for x in tags
-        if x.startswith(f"{target}_")
-        and (target == "rootfs" or len(x[len(target) + 1 :]) > 10)
-    ]
-    target_tags.sort()
-    digest_cache = {
-        tag: hex_to_base62(image_digest_cached(f"{REPO}:{tag}", skip_manifest=True))
-        for tag in target_tags
-    }
-    diff_tags = (
-        [
-            x
-            for x in tags
-            if x.startswith("_diff-") and len(x) == (43 * 2) + 1 + 6 and x[49] == "-"
-        ]
-        if missing_only
-        else []
-    )
+def _tag_date(target: str, tag: str) -> date | None:
+    try:
+        return datetime.strptime(tag[len(target) + 1 :][:10], "%Y.%m.%d").date()
+
+    except ValueError:
+        return None
+
+
+def _adjacent_pairs(target_tags: list[str]) -> Iterable[tuple[int, int]]:
     for i in range(len(target_tags)):
         for offset in range(1, 4):
             if i + offset < len(target_tags):
-                a, b = target_tags[i], target_tags[i + offset]
-                if digest_cache[a] == digest_cache[b]:
-                    continue
+                yield i, i + offset
+
+
+def _adaptive_pairs(target: str, target_tags: list[str]) -> Iterable[tuple[int, int]]:
+    # Most clients are only a few builds behind, so those go straight to the
+    # newest build. Clients that have not updated in a while catch up through
+    # the last build of each week, and the chain of consecutive builds keeps
+    # every build reachable through multiple hops.
+    newest = len(target_tags) - 1
+    if newest < 1:
+        return
+
+    weeks: dict[tuple[int, int], int] = {}
+    for i, tag in enumerate(target_tags):
+        day = _tag_date(target, tag)
+        if day is not None:
+            weeks[day.isocalendar()[:2]] = i
+
+    anchors = sorted(weeks.values(), reverse=True)
+    for i in range(newest - 1, max(newest - 1 - RECENT_BUILDS, -1), -1):
+        yield i, newest
+
+    for i in anchors[:ANCHOR_WEEKS]:
+        if i != newest:
+            yield i, newest
+
+    for i in range(newest - 1, -1, -1):
+        yield i, i + 1
+
+    for a, b in zip(anchors[1:], anchors):
+        yield a, b
+
+
+def get_deltas(
+    target: str,
+    missing_only: bool = False,
+    strategy: str = STRATEGIES[0],
+    budget: int = 0,
+    snapshot: TagSnapshot | None = None,
+) -> Iterable[tuple[str, str, str]]:
+    if snapshot is None:
+        snapshot = tag_snapshot()
+
+    target_tags = snapshot.variant(target)
+    # Digests are only looked up for tags that end up in a pair, which matters
+    # when the budget is hit early
+    digest_cache: dict[str, str] = {}
+
+    def digest(tag: str) -> str:
+        if tag not in digest_cache:
+            digest_cache[tag] = hex_to_base62(
+                image_digest_cached(f"{REPO}:{tag}", skip_manifest=True)
+            )
+
+        return digest_cache[tag]
+
+    pairs = (
+        _adaptive_pairs(target, target_tags)
+        if strategy == "adaptive"
+        else _adjacent_pairs(target_tags)
+    )
+    seen: set[str] = set()
+    for i, j in pairs:
+        a, b = target_tags[i], target_tags[j]
+        src, dst = digest(a), digest(b)
+        if src == dst:
+            continue
+
+        t = f"_diff-{src}-{dst}"
+        if t in seen or (missing_only and snapshot.has_diff(src, dst)):
+            continue
 
-                t = f"_diff-{digest_cache[a]}-{digest_cache[b]}"
-                if t not in diff_tags:
-                    yield a, b, t
+        seen.add(t)
+        yield a, b, t
+        if len(seen) == budget:
+            return
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
-import itertools
+import asyncio
+import heapq
 import json
 import os
-import tempfile
+import sqlite3
 import _os  # pyright: ignore[reportMissingImports]
 
 from datetime import datetime
@@ -9,31 +10,34 @@ from datetime import UTC
 from argparse import ArgumentParser
 from argparse import Namespace
 from collections import defaultdict
-from collections import deque
+from collections.abc import AsyncIterator
 from collections.abc import Iterable
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import as_completed
 from typing import Any
 from typing import cast
 
 from . import image_tags
 from . import hex_to_base62
+from . import classify_tags
 from . import progress_bar
-from . import image_size_cached
-from . import podman
-from . import chronic
-from . import podman_cmd
-from . import escape_label
+from . import registry_pool
+from . import create_image
+from . import encode_delta_map
+from . import prune_digest_cache
 from . import _image_size_cached  # pyright: ignore[reportPrivateUsage]
 from . import _image_digest_cached  # pyright: ignore[reportPrivateUsage]
 from . import _image_digests_write_cache  # pyright: ignore[reportPrivateUsage]
+from . import DIGEST_CACHE_PATH
+from . import MANIFEST_VERSION
 from . import REPO
 
 from .config import parse_all_config
 
 
 MAX_SIZE_RATIO = cast(float, _os.podman.MAX_SIZE_RATIO)  # pyright: ignore[reportUnknownMemberType]
+MANIFEST_INDEX_PATH = os.path.join(os.path.dirname(DIGEST_CACHE_PATH), "manifest_index")
+MANIFEST_INDEX_VERSION = 1
 
 
 kwds: dict[str, str] = {
@@ -47,79 +51,147 @@ def register(parser: ArgumentParser):
         action="store_true",
         help="Push the manifest after it builds",
     )
+    _ = parser.add_argument(
+        "--horizon",
+        type=int,
+        default=90,
+        metavar="DAYS",
+        help="Only generate routes between builds at most this many days apart, 0 for no limit",
+    )
+    _ = parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the persistent index and recalculate everything",
+    )
+
+
+class _Completed[K, V]:
+    def __init__(self):
+        self.count: int = 0
+        self._queue: asyncio.Queue[tuple[K, V | Exception]] = asyncio.Queue()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def add(self, key: K, value: Future[V] | V):
+        self.count += 1
+        if not isinstance(value, Future):
+            self._queue.put_nowait((key, value))
+            return
+
+        task = asyncio.ensure_future(self._wait(key, value))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _wait(self, key: K, future: Future[V]):
+        try:
+            value: V | Exception = await asyncio.wrap_future(future)
+
+        except Exception as e:
+            value = e
+
+        await self._queue.put((key, value))
+
+    async def __aiter__(self) -> AsyncIterator[tuple[K, V]]:
+        for _ in range(self.count):
+            key, value = await self._queue.get()
+            if isinstance(value, Exception):
+                raise value
+
+            yield key, value
+
+
+async def _wait_for[T](value: Future[T] | T) -> T:
+    if isinstance(value, Future):
+        return await asyncio.wrap_future(cast(Future[T], value))
+
+    return value
 
 
 def command(args: Namespace):
+    asyncio.run(_command(args))
+
+
+async def _command(args: Namespace):
+    horizon = cast(int, args.horizon) or None
     config = parse_all_config()
+    index = _open_index(MANIFEST_INDEX_PATH, reset=cast(bool, args.full))
+    index_meta = dict(
+        cast(list[tuple[str, str]], index.execute("SELECT key, value FROM meta"))
+    )
+    index_tags = dict(
+        cast(list[tuple[str, str]], index.execute("SELECT tag, digest FROM tags"))
+    )
+    index_edges = {
+        tag: (src, dst, size)
+        for tag, src, dst, size in cast(
+            list[tuple[str, str, str, int]],
+            index.execute("SELECT tag, src, dst, size FROM edges"),
+        )
+    }
+    index_digests = {
+        b62: (None if sort_key is None else cast(list[int], json.loads(sort_key)), size)
+        for b62, sort_key, size in cast(
+            list[tuple[str, str | None, int | None]],
+            index.execute("SELECT b62, sort_key, size FROM digests"),
+        )
+    }
     print("Getting all tags...")
     all_tags = image_tags(REPO, True)
     assert all_tags, "No tags found"
     digest_info: dict[str, tuple[list[str], str]] = {}
     graph: defaultdict[str, dict[str, tuple[str, int]]] = defaultdict(dict)
     digest_worker_queue: list[tuple[str, str]] = []
-    valid_variants = ["rootfs", *config["variants"].keys()]
-    for tag in progress_bar(
-        all_tags,
-        prefix="Classifying tags:" + " " * 9,
-    ):
-        kind, a, b = _classify_tag(tag)
+    tag_versions: dict[str, str] = {}
+    valid_variants = {"rootfs", *config["variants"].keys()}
+    templates = {
+        y
+        for x in config["variants"].values()
+        for y in cast(list[str], x.get("templates", []))
+    }
+    print("Classifying tags...")
+    for tag, (kind, variant, version, _build, src, dst) in classify_tags(
+        all_tags
+    ).items():
         if kind in ("other", "manifest"):
             continue
 
         if kind == "diff":
-            if a and b:
-                graph[a][b] = (tag, -1)
-
+            assert src and dst
+            graph[src][dst] = (tag, -1)
             continue
 
-        if kind not in ("build", "version", "variant"):
-            digest_worker_queue.append((kind, tag))
+        assert variant
+        parts = variant.split("-", 1)
+        if parts[0] not in valid_variants:
             continue
 
-        assert a
-        parts = a.split("-", 1)
-        variant = parts[0]
-        if variant not in valid_variants:
+        if len(parts) > 1 and parts[1] not in templates:
             continue
 
-        if "-" in a and parts[1] not in [
-            y
-            for x in config["variants"].values()
-            for y in cast(list[str], x.get("templates", []))
-        ]:
-            continue
+        if kind != "variant":
+            assert version
+            tag_versions[tag] = version
 
         digest_worker_queue.append((kind, tag))
 
     assert digest_worker_queue, "No tags found"
 
-    def _digest_worker(data: tuple[str, str]) -> tuple[str, str, Future[str] | str]:
-        image = f"{REPO}:{data[1]}"
-        future = _image_digest_cached(image, skip_manifest=True)
-        if isinstance(future, Future):
-            future.add_done_callback(
-                lambda x: _image_digests_write_cache(image, x.result())
-            )
+    def _add_digest(tag: str, digest: str):
+        b62 = hex_to_base62(digest)
+        if b62 not in digest_info:
+            digest_info[b62] = ([], digest)
 
-        return *data, future
+        digest_info[b62] = (digest_info[b62][0] + [tag], digest)
 
-    with ThreadPoolExecutor(max_workers=50) as exc:
-        for future in progress_bar(
-            as_completed([exc.submit(_digest_worker, x) for x in digest_worker_queue]),
-            count=len(digest_worker_queue),
-            prefix="Getting tag digests:" + " " * 6,
-        ):
-            kind, tag, digest = future.result()
-            if isinstance(digest, Future):
-                digest = digest.result()
+    # Build tags are never pushed twice, so they can be reused from the index.
+    # Variant and version tags move with every build and are always resolved
+    build_tags = {tag for kind, tag in digest_worker_queue if kind == "build"}
+    for tag in build_tags:
+        if tag in index_tags:
+            _add_digest(tag, index_tags[tag])
 
-            b62 = hex_to_base62(digest)
-            if b62 not in digest_info:
-                digest_info[b62] = ([], digest)
-
-            digest_info[b62] = (digest_info[b62][0] + [tag], digest)
-
-    # TODO remove all delta tags that are not used
+    digest_worker_queue = [
+        x for x in digest_worker_queue if x[0] != "build" or x[1] not in index_tags
+    ]
 
     def flatten(
         d: dict[str, dict[str, tuple[str, int]]],
@@ -128,12 +200,107 @@ def command(args: Namespace):
             for key, value in inner_dict.items():
                 yield inner_dict, key, value
 
-    for d, key, (tag, _size) in progress_bar(
-        flatten(graph),
-        count=len(list(flatten(graph))),
-        prefix="Calculating sizes:" + " " * 8,
+    for d, key, (tag, _size) in list(flatten(graph)):
+        if tag in index_edges:
+            d[key] = (tag, index_edges[tag][2])
+
+    direct_sizes: dict[str, int] = {
+        b62: size
+        for b62, (_sort_key, size) in index_digests.items()
+        if size is not None
+    }
+    # Digest and delta size lookups all run on registry_pool at the same time.
+    # The direct size of every new digest is requested as soon as the digest
+    # is known, so it is ready by the time routes need it.
+    digest_lookups: _Completed[str, str] = _Completed()
+    for _kind, tag in digest_worker_queue:
+        image = f"{REPO}:{tag}"
+        digest = _image_digest_cached(image, skip_manifest=True)
+        if isinstance(digest, Future):
+            digest.add_done_callback(
+                lambda x, image=image: _image_digests_write_cache(image, x.result())
+            )
+
+        digest_lookups.add(tag, digest)
+
+    size_lookups: _Completed[tuple[str, dict[str, tuple[str, int]], str], int] = (
+        _Completed()
+    )
+    for d, key, (tag, size) in flatten(graph):
+        if size == -1:
+            size_lookups.add((tag, d, key), _image_size_cached(f"{REPO}:{tag}"))
+
+    prefetched: set[str] = set()
+    async for tag, digest in progress_bar(
+        digest_lookups,
+        count=digest_lookups.count,
+        prefix="Getting digests:" + " " * 10,
     ):
-        d[key] = (tag, image_size_cached(f"{REPO}:{tag}"))
+        _add_digest(tag, digest)
+        b62 = hex_to_base62(digest)
+        if b62 not in direct_sizes and b62 not in prefetched:
+            prefetched.add(b62)
+            _ = _image_size_cached(f"{REPO}:{tag}")
+
+    # The order and the affected digests need every digest, so this is the
+    # one barrier. Delta sizes keep arriving from here on.
+    order: dict[str, tuple[int, int, int]] = {}
+    for b62, (tags, _digest) in digest_info.items():
+        keys = [
+            key
+            for t in tags
+            if t in tag_versions
+            for key in [_version_key(tag_versions[t])]
+            if key is not None
+        ]
+        if keys:
+            order[b62] = min(keys)
+
+    # Any digest whose edges, tags or position changed since the last run
+    # invalidates the routes of every digest that can reach it. Edges without
+    # a size yet are never in the index, so they are dirty either way
+    edges = {
+        tag: (a, b, size) for a, d in graph.items() for b, (tag, size) in d.items()
+    }
+    dirty = {
+        x
+        for tag in edges.keys() ^ index_edges.keys()
+        for x in (edges.get(tag) or index_edges[tag])[:2]
+    }
+    dirty.update(
+        x
+        for tag in edges.keys() & index_edges.keys()
+        if edges[tag] != index_edges[tag]
+        for x in edges[tag][:2] + index_edges[tag][:2]
+    )
+    dirty.update(digest_info.keys() ^ index_digests.keys())
+    dirty.update(
+        b62
+        for b62 in digest_info.keys() & index_digests.keys()
+        if list(order.get(b62, ())) != (index_digests[b62][0] or [])
+    )
+    reverse: defaultdict[str, set[str]] = defaultdict(set)
+    for a, b, _size in [*edges.values(), *index_edges.values()]:
+        reverse[b].add(a)
+
+    affected = set(dirty)
+    stack = list(dirty)
+    while stack:
+        for parent in reverse[stack.pop()]:
+            if parent not in affected:
+                affected.add(parent)
+                stack.append(parent)
+
+    if index_meta.get("horizon") != str(horizon):
+        affected.update(digest_info.keys())
+
+    routes: dict[str, dict[str, tuple[int, list[str]]]] = defaultdict(dict)
+    for src, dst, cost, path in cast(
+        list[tuple[str, str, int, str]],
+        index.execute("SELECT src, dst, cost, path FROM routes"),
+    ):
+        if src not in affected and src in digest_info and dst in digest_info:
+            routes[src][dst] = (cost, cast(list[str], json.loads(path)))
 
     labels: dict[str, str] = {}
     for b62, (tags, digest) in progress_bar(
@@ -142,149 +309,269 @@ def command(args: Namespace):
         for tag in tags:
             labels[f"tag.{tag}"] = digest
 
-    b62_list = list(digest_info.keys())
-    delta_map: defaultdict[str, dict[str, list[str]]] = defaultdict(dict)
-
-    def _delta_worker(data: tuple[str, str]) -> tuple[str, str, int, list[str]] | None:
-        a_b62, b_b62 = data
-        cost, path = shortest_path(a_b62, b_b62, graph)
-        if cost is None or not path:
-            return None
-
-        return b_b62, a_b62, cost, path
+    # Each affected source only waits for the sizes of the edges it can
+    # reach, and its shortest paths are calculated on a worker thread as soon
+    # as the last of them arrives. Routes from unaffected digests come
+    # straight from the index.
+    sources = [x for x in digest_info.keys() if x in affected]
+    parents: defaultdict[str, set[str]] = defaultdict(set)
+    for a, b, _size in edges.values():
+        parents[b].add(a)
+
+    waiting: dict[str, int] = dict.fromkeys(sources, 0)
+    waiters: defaultdict[str, list[str]] = defaultdict(list)
+    for tag, (a, _b, size) in edges.items():
+        if size != -1:
+            continue
 
-    with ThreadPoolExecutor(max_workers=50) as exc:
-        combinations = list(itertools.combinations(b62_list, 2))
-        for future in progress_bar(
-            as_completed([exc.submit(_delta_worker, x) for x in combinations]),
-            count=len(combinations),
-            prefix="Calculating deltas:" + " " * 7,
+        seen = {a}
+        stack = [a]
+        while stack:
+            for parent in parents[stack.pop()]:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+
+        for source in seen & waiting.keys():
+            waiting[source] += 1
+            waiters[tag].append(source)
+
+    def _shortest_paths(a_b62: str) -> dict[str, tuple[int, list[str]]]:
+        return {
+            b_b62: route
+            for b_b62, route in shortest_paths(a_b62, graph, order, horizon).items()
+            if b_b62 != a_b62 and b_b62 in digest_info
+        }
+
+    found: _Completed[str, dict[str, tuple[int, list[str]]]] = _Completed()
+    for a_b62 in digest_info.keys():
+        if a_b62 not in affected and a_b62 in routes:
+            found.add(a_b62, routes[a_b62])
+
+    with ThreadPoolExecutor() as pool:
+        for a_b62 in sources:
+            if not waiting[a_b62]:
+                found.add(a_b62, pool.submit(_shortest_paths, a_b62))
+
+        async for (tag, d, key), size in progress_bar(
+            size_lookups,
+            count=size_lookups.count,
+            prefix="Getting delta sizes:" + " " * 6,
         ):
-            item = future.result()
-            if item is None:
-                continue
-
-            b_b62, a_b62, cost, path = item
-            sizes = [
-                x
-                for t in digest_info[b_b62][0]
-                for x in [_image_size_cached(f"{REPO}:{t}")]
-            ]
-            b_direct: int = min(
-                [x.result() if isinstance(x, Future) else x for x in sizes]
-            )
-            if cost >= b_direct * MAX_SIZE_RATIO:
-                continue
-
-            delta_map[b_b62][a_b62] = path
-
+            d[key] = (tag, size)
+            for a_b62 in waiters.pop(tag, []):
+                waiting[a_b62] -= 1
+                if not waiting[a_b62]:
+                    found.add(a_b62, pool.submit(_shortest_paths, a_b62))
+
+        delta_map: defaultdict[str, dict[str, list[str]]] = defaultdict(dict)
+
+        async def _direct_size(b62: str) -> int:
+            size = direct_sizes.get(b62)
+            if size is None:
+                sizes = [_image_size_cached(f"{REPO}:{t}") for t in digest_info[b62][0]]
+                size = min([await _wait_for(x) for x in sizes])
+                direct_sizes[b62] = size
+
+            return size
+
+        async for a_b62, targets in progress_bar(
+            found,
+            count=found.count,
+            prefix="Calculating routes:" + " " * 7,
+        ):
+            routes[a_b62] = targets
+            for b_b62, (cost, path) in targets.items():
+                if cost >= await _direct_size(b_b62) * MAX_SIZE_RATIO:
+                    continue
+
+                delta_map[b_b62][a_b62] = path
+
+    edges = {
+        tag: (a, b, size) for a, d in graph.items() for b, (tag, size) in d.items()
+    }
+    print("Updating index...")
+    with index:
+        _ = index.execute("DELETE FROM tags")
+        _ = index.executemany(
+            "INSERT INTO tags (tag, digest) VALUES (?, ?)",
+            [
+                (tag, digest)
+                for tags, digest in digest_info.values()
+                for tag in tags
+                if tag in build_tags
+            ],
+        )
+        _ = index.execute("DELETE FROM edges")
+        _ = index.executemany(
+            "INSERT INTO edges (tag, src, dst, size) VALUES (?, ?, ?, ?)",
+            [(tag, a, b, size) for tag, (a, b, size) in edges.items()],
+        )
+        _ = index.execute("DELETE FROM digests")
+        _ = index.executemany(
+            "INSERT INTO digests (b62, sort_key, size) VALUES (?, ?, ?)",
+            [
+                (
+                    b62,
+                    json.dumps(order[b62]) if b62 in order else None,
+                    direct_sizes.get(b62),
+                )
+                for b62 in digest_info.keys()
+            ],
+        )
+        _ = index.execute("DELETE FROM routes")
+        _ = index.executemany(
+            "INSERT INTO routes (src, dst, cost, path) VALUES (?, ?, ?, ?)",
+            [
+                (a, b, cost, json.dumps(path, separators=(",", ":")))
+                for a, targets in routes.items()
+                for b, (cost, path) in targets.items()
+            ],
+        )
+        _ = index.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('horizon', ?)",
+            (str(horizon),),
+        )
+
+    index.close()
+    prune_digest_cache(REPO, all_tags)
+    registry_pool.report()
+
+    # Maps refer to digests by their position in this list instead of
+    # repeating the delta tags, see encode_delta_map
+    digests: dict[str, int] = {}
+    for item in delta_map.values():
+        for path in item.values():
+            for tag in path:
+                for b62 in tag[6:].split("-"):
+                    _ = digests.setdefault(b62, len(digests))
+
+    labels["digests"] = ",".join(digests.keys())
     for b_b62, item in progress_bar(
         delta_map.items(),
         prefix="Generating map labels:" + " " * 4,
     ):
-        labels[f"map.{b_b62}"] = json.dumps(item, separators=(",", ":"), indent=2)
+        labels[f"map.{b_b62}"] = encode_delta_map(b_b62, item, digests)
 
     labels["timestamp"] = datetime.now(tz=UTC).replace(microsecond=0).isoformat() + "Z"
-    with tempfile.TemporaryDirectory() as tmpdir:
-        containerfile = os.path.join(tmpdir, "Containerfile")
-        with open(containerfile, "w") as f:
-            _ = f.write("FROM scratch\nLABEL \\")
-            for k, v in progress_bar(
-                labels.items(), prefix="Generating Containerfile: "
-            ):
-                _ = f.write(f'\n  arkes.manifest.{k}="{escape_label(v)}" \\')
-
-            _ = f.write('\n  arkes.manifest.version="1"\n')
-
-        image = f"{REPO}:_manifest"
-        print(f"Building {image}...")
-        try:
-            chronic(
-                podman_cmd(
-                    "build",
-                    f"--tag={image}",
-                    f"--file={containerfile}",
-                    tmpdir,
-                )
-            )
-
-        except:
-            with (
-                open(containerfile, "r") as f,
-                open("/tmp/manifest.Containerfile", "w") as out,
-            ):
-                _ = out.write(f.read())
-
-            raise
-        if cast(bool, args.push):
-            podman("push", image)
-
-
-def _classify_tag(tag: str) -> tuple[str, str | None, str | None]:
-    if tag == "_manifest":
-        return "manifest", None, None
-
-    if tag.startswith("_diff-"):
-        if len(tag) != 93 or tag[49] != "-":
-            return "other", None, None
-
-        src_b62 = tag[6:49]
-        dst_b62 = tag[50:]
-        if len(src_b62) != 43 or len(dst_b62) != 43:
-            return "other", None, None
-
-        return "diff", src_b62, dst_b62
-
-    if "_" not in tag:
-        if all(c.isalnum() or c == "-" for c in tag):
-            return "variant", tag, None
-
-        return "other", None, None
-
-    sep_idx = tag.rfind("_")
-    if sep_idx <= 0:
-        return "other", None, None
-
-    variant = tag[:sep_idx]
-    rest = tag[sep_idx + 1 :]
-    if not (variant and all(c.isalnum() or c == "-" for c in variant)):
-        return "other", None, None
-
-    if "." in rest:
-        last_dot = rest.rfind(".")
-        if last_dot > 0:
-            build_num = rest[last_dot + 1 :]
-            if build_num.isdigit():
-                version_part = rest[:last_dot]
-                full_version = f"{version_part}.{build_num}"
-                return "build", variant, full_version
-
-    if rest and all(c.isalnum() or c in ".-" for c in rest):
-        return "version", variant, rest
-
-    return "other", None, None
+    labels["version"] = str(MANIFEST_VERSION)
+    image = f"{REPO}:_manifest"
+    print(f"Building {image}...")
+    create_image(
+        image,
+        {f"arkes.manifest.{k}": v for k, v in labels.items()},
+        push=cast(bool, args.push),
+    )
 
 
-def shortest_path(
-    a: str, b: str, graph: dict[str, dict[str, tuple[str, int]]]
-) -> tuple[int | None, list[str] | None]:
-    if a == b:
-        return 0, []
+def _open_index(path: str, reset: bool = False) -> sqlite3.Connection:
+    try:
+        index = sqlite3.connect(path)
+        version = cast(int, index.execute("PRAGMA user_version").fetchone()[0])
+
+    except sqlite3.DatabaseError as e:
+        print(f"Failed to load manifest index: {e}")
+        os.unlink(path)
+        index = sqlite3.connect(path)
+        version = 0
+
+    if reset or version != MANIFEST_INDEX_VERSION:
+        _ = index.executescript(f"""
+            DROP TABLE IF EXISTS meta;
+            DROP TABLE IF EXISTS tags;
+            DROP TABLE IF EXISTS edges;
+            DROP TABLE IF EXISTS digests;
+            DROP TABLE IF EXISTS routes;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE tags (tag TEXT PRIMARY KEY, digest TEXT NOT NULL);
+            CREATE TABLE edges (
+                tag TEXT PRIMARY KEY,
+                src TEXT NOT NULL,
+                dst TEXT NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE digests (b62 TEXT PRIMARY KEY, sort_key TEXT, size INTEGER);
+            CREATE TABLE routes (
+                src TEXT NOT NULL,
+                dst TEXT NOT NULL,
+                cost INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (src, dst)
+            );
+            PRAGMA user_version = {MANIFEST_INDEX_VERSION};
+        """)
+
+    return index
+
+
+def _version_key(version: str) -> tuple[int, int, int] | None:
+    parts = version.split(".")
+    try:
+        date = datetime.strptime(".".join(parts[:3]), "%Y.%m.%d")
+
+    except ValueError:
+        return None
+
+    # Build numbers are HHMMSS followed by an unpadded centisecond count
+    build = parts[3] if len(parts) > 3 else ""
+    if build and not build.isdigit():
+        return None
+
+    return date.toordinal(), int(build[:6] or 0), int(build[6:] or 0)
+
+
+def shortest_paths(
+    a: str,
+    graph: dict[str, dict[str, tuple[str, int]]],
+    order: dict[str, tuple[int, int, int]] | None = None,
+    horizon: int | None = None,
+) -> dict[str, tuple[int, list[str]]]:
+    # When the chronological order of the digests is known, only follow edges
+    # that move forward in time, and stay within horizon days of the source
+    start = None if order is None else order.get(a)
+    dist: dict[str, int] = {a: 0}
+    prev: dict[str, tuple[str, str]] = {}
+    settled: list[str] = []
+    heap: list[tuple[int, str]] = [(0, a)]
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > dist[node]:
+            continue
 
-    queue = deque([(a, 0, cast(list[str], []))])
-    visited: dict[str, tuple[int, list[str]]] = {a: (0, [])}
-    while queue:
-        node, cost, path = queue.popleft()
+        settled.append(node)
         for neigh, (tag, sz) in graph.get(node, {}).items():
-            if sz == -1:
+            # Placeholder deltas for pairs that were too large have no layers
+            if sz <= 0:
                 continue
 
-            new_cost = cost + sz
-            if neigh not in visited or new_cost < visited[neigh][0]:
-                visited[neigh] = (new_cost, path + [tag])
-                queue.append((neigh, new_cost, path + [tag]))
+            if order is not None:
+                key = order.get(node)
+                neigh_key = order.get(neigh)
+                if key is not None and neigh_key is not None and neigh_key <= key:
+                    continue
 
-    return visited.get(b, (None, None))
+                if (
+                    horizon is not None
+                    and start is not None
+                    and neigh_key is not None
+                    and neigh_key[0] - start[0] > horizon
+                ):
+                    continue
+
+            new_cost = cost + sz
+            if neigh not in dist or new_cost < dist[neigh]:
+                dist[neigh] = new_cost
+                prev[neigh] = (node, tag)
+                heapq.heappush(heap, (new_cost, neigh))
+
+    # Nodes are settled in cost order, so a node's predecessor always has its
+    # path built before the node itself
+    paths: dict[str, tuple[int, list[str]]] = {a: (0, [])}
+    for node in settled[1:]:
+        parent, tag = prev[node]
+        paths[node] = (dist[node], paths[parent][1] + [tag])
+
+    return paths
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import json
+import socket
+import threading
+
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPResponse
+from typing import cast
+from typing import override
+from urllib.parse import quote
+from urllib.parse import urlencode
+
+API_VERSION = "v4.0.0"
+MAX_CONNECTIONS = 4
+
+
+class LibpodError(Exception):
+    def __init__(self, status: int, reason: str, path: str):
+        super().__init__(f"{status} {reason}: {path}")
+        self.status: int = status
+        self.reason: str = reason
+        self.path: str = path
+
+
+class _UnixConnection(HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__("localhost", timeout=60)
+        self.socket_path: str = path
+
+    @override
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock: socket.socket = sock
+
+
+class Libpod:
+    def __init__(self, path: str, max_connections: int = MAX_CONNECTIONS):
+        self.path: str = path
+        self.max_connections: int = max_connections
+        self._pool: list[_UnixConnection] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    def _connection(self) -> _UnixConnection:
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+
+        return _UnixConnection(self.path)
+
+    def _release(self, conn: _UnixConnection):
+        with self._lock:
+            if len(self._pool) < self.max_connections:
+                self._pool.append(conn)
+                return
+
+        conn.close()
+
+    def _send(self, method: str, path: str) -> tuple[HTTPResponse, bytes]:
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path)
+                res = conn.getresponse()
+                body = res.read()
+
+            except (HTTPException, OSError):
+                conn.close()
+                # Pooled connections may have been closed by podman since they
+                # were last used, so retry once with a fresh one
+                if attempt:
+                    raise
+
+                continue
+
+            if res.will_close:
+                conn.close()
+
+            else:
+                self._release(conn)
+
+            return res, body
+
+        raise AssertionError("unreachable")
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        query: list[tuple[str, str]] | None = None,
+        allow: tuple[int, ...] = (),
+    ) -> tuple[HTTPResponse, bytes]:
+        url = f"/{API_VERSION}/libpod/{path}"
+        if query:
+            url = f"{url}?{urlencode(query)}"
+
+        res, body = self._send(method, url)
+        if res.status >= 400 and res.status not in allow:
+            raise LibpodError(res.status, res.reason, url)
+
+        return res, body
+
+    def exists(self, image: str) -> bool:
+        res, _ = self.request(
+            "GET", f"images/{quote(image, safe='')}/exists", allow=(404,)
+        )
+        return res.status == 204
+
+    def inspect(self, image: str) -> dict[str, object]:
+        _, body = self.request("GET", f"images/{quote(image, safe='')}/json")
+        return cast(dict[str, object], json.loads(body))
+
+    def tag(self, image: str, target: str):
+        repo, tag = (
+            target.rsplit(":", 1)
+            if ":" in target.split("/")[-1]
+            else (target, "latest")
+        )
+        _ = self.request(
+            "POST",
+            f"images/{quote(image, safe='')}/tag",
+            [("repo", repo), ("tag", tag)],
+        )
+
+    def remove(self, *images: str):
+        res, body = self.request(
+            "DELETE", "images/remove", [("images", x) for x in images]
+        )
+        # Failures to remove individual images are reported in the body of a
+        # successful response
+        report = cast(dict[str, object], json.loads(body or b"{}"))
+        errors = cast(list[str] | None, report.get("Errors")) or []
+        exit_code = cast(int | None, report.get("ExitCode")) or 0
+        if exit_code or errors:
+            raise LibpodError(
+                res.status,
+                "; ".join(errors) or f"exit code {exit_code}",
+                "images/remove",
+            )
+
+
+_clients: dict[str, Libpod] = {}
+_clients_lock = threading.Lock()
+
+
+def get_libpod(path: str) -> Libpod:
+    with _clients_lock:
+        if path not in _clients:
+            _clients[path] = Libpod(path)
+
+        return _clients[path]
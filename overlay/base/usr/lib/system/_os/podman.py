@@ -1,20 +1,30 @@
 # pyright: reportImportCycles=false
 import atexit
+import base64
 import os
+import re
 import shlex
 import shutil
 import string
+import struct
 import tarfile
 import subprocess
 import json
+import threading
 
 from tempfile import TemporaryDirectory
 from time import time
+from datetime import UTC
+from datetime import datetime
+from hashlib import file_digest
 from hashlib import sha256
 from glob import iglob
-from typing import IO, Any, cast
+from functools import lru_cache
+from typing import IO, Any, NamedTuple, cast, override
 from typing import Callable
-from collections.abc import Generator, Iterable
+from collections import Counter
+from collections.abc import Generator, Iterable, Iterator, Mapping
+from contextlib import ExitStack
 from contextlib import contextmanager
 
 from . import OS_NAME
@@ -26,15 +36,103 @@ from . import REPO
 from .system import execute
 from .system import _execute  # pyright:ignore [reportPrivateUsage]
 from .ostree import ostree
+from .registry import get_registry
+from .registry import RegistryError
+from .registry import ARCHITECTURE
+from .libpod import Libpod
+from .libpod import get_libpod
 
 from .console import bytes_to_iec, bytes_to_stdout
 from .console import bytes_to_stderr
 
 MAX_SIZE_RATIO = 0.6
+# Either "skopeo" to shell out for every registry request, or "native" to use
+# the built in registry client
+REGISTRY_BACKEND = os.environ.get("REGISTRY_BACKEND", "skopeo")
+# Either "cli" to run podman for every local image operation, or "api" to use
+# the REST API on the podman socket for inspect, exists, tag and rmi
+PODMAN_BACKEND = os.environ.get("PODMAN_BACKEND", "cli")
+PODMAN_SOCKET = "/run/podman/podman.sock"
+MANIFEST_TTL = 300.0
+IMAGE_REF_CACHE_SIZE = 4096
+# 1 stores each map as JSON, 2 as a next-hop table into the digest list
+MANIFEST_VERSION = 2
+# Only skip encoding when the prediction is clearly over MAX_SIZE_RATIO
+ESTIMATE_MARGIN = 1.25
+# Real encodes needed before the layer estimate is calibrated enough to skip
+# pairs with
+DELTA_HISTORY_MIN = 8
+# Saved archives of the running image can be kept between updates by setting
+# this to a size in bytes, at the cost of that much disk space
+ARCHIVE_CACHE_PATH = "/var/cache/system/archives"
+ARCHIVE_CACHE_SIZE = int(os.environ.get("ARCHIVE_CACHE_SIZE", 0))
+PATCH_FORMATS = ["xdelta3+zstd", "layers+xdelta3+zstd", "zstd-patch"]
+PATCH_FILES = {
+    "xdelta3+zstd": "diff.xd3.zstd",
+    "layers+xdelta3+zstd": "diff.layers.tar",
+    "zstd-patch": "diff.zst",
+}
+# name: (patch format, xdelta3 arguments, zstd arguments)
+DELTA_PROFILES: dict[str, tuple[str, list[str], list[str]]] = {
+    "xdelta3": ("xdelta3+zstd", ["-0", "-S", "none"], ["-19", "-T0"]),
+    "xdelta3-fast": ("xdelta3+zstd", ["-0", "-S", "none"], ["-6", "-T0"]),
+    "xdelta3-ultra": (
+        "xdelta3+zstd",
+        ["-0", "-S", "none", "-B", str(1024**3)],
+        ["--ultra", "-22", "-T0"],
+    ),
+    "layers": ("layers+xdelta3+zstd", ["-0", "-S", "none"], ["-19", "-T0"]),
+    "zstd-long": ("zstd-patch", [], ["-19", "-T0", "--long=31"]),
+    "zstd-long-fast": ("zstd-patch", [], ["-6", "-T0", "--long=31"]),
+}
+DEFAULT_DELTA_PROFILE = "xdelta3"
+
+
+class PodmanEnvironment(NamedTuple):
+    container: bool
+    rootless: bool
+    socket: str | None
+
+
+@lru_cache(maxsize=None)
+def podman_environment() -> PodmanEnvironment:
+    try:
+        container = not subprocess.call(
+            ["systemd-detect-virt", "--quiet", "--container"]
+        )
+
+    except FileNotFoundError:
+        container = False
+
+    rootless = os.geteuid() != 0
+    host = os.environ.get("CONTAINER_HOST", "")
+    if host.startswith("unix://"):
+        socket = host[7:]
+
+    elif rootless:
+        socket = os.path.join(
+            os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}"),
+            "podman/podman.sock",
+        )
+
+    else:
+        socket = PODMAN_SOCKET
+
+    return PodmanEnvironment(
+        container, rootless, socket if os.path.exists(socket) else None
+    )
+
+
+def podman_api() -> Libpod | None:
+    socket = podman_environment().socket
+    if PODMAN_BACKEND != "api" or socket is None:
+        return None
+
+    return get_libpod(socket)
 
 
 def podman_cmd(*args: str) -> list[str]:
-    if _execute("systemd-detect-virt --quiet --container") == 0:
+    if podman_environment().container:
         return ["podman", "--remote", *args]
 
     return ["podman", *args]
@@ -45,6 +143,22 @@ def podman(
     onstdout: Callable[[bytes], None] = bytes_to_stdout,
     onstderr: Callable[[bytes], None] = bytes_to_stderr,
 ):
+    api = podman_api()
+    if api is not None and args and not any(x.startswith("-") for x in args[1:]):
+        match args:
+            case ("tag", image, *targets) if targets:
+                for target in targets:
+                    api.tag(image, target)
+
+                return
+
+            case ("rmi", *images) if images:
+                api.remove(*images)
+                return
+
+            case _:
+                pass
+
     execute(
         *podman_cmd(*args),
         onstdout=onstdout,
@@ -175,8 +289,22 @@ def system_hash() -> str:
     return local_info.get("BUILD_ID", "0000-00-00.0").split(".", 1)[1]
 
 
+def _native_reference(image: str) -> tuple[str, str, str]:
+    ref = image_ref(image)
+    assert ref.registry is not None, f"{image} has no registry"
+    return ref.registry, ref.repo, ref.digest or ref.tag or "latest"
+
+
 def image_info(image: str, remote: bool = True) -> dict[str, object]:
     image = image_qualified_name(image)
+    if remote and REGISTRY_BACKEND == "native":
+        name, repo, reference = _native_reference(image)
+        return get_registry(name).inspect(repo, reference)
+
+    api = podman_api()
+    if not remote and api is not None:
+        return api.inspect(image)
+
     if remote:
         args = ["skopeo", "inspect", f"docker://{image}"]
 
@@ -196,39 +324,39 @@ def image_hash(image: str, remote: bool = True) -> str:
 
 
 def image_exists(image: str, remote: bool = True, skip_manifest: bool = False) -> bool:
-    image_exists = not _execute(shlex.join(podman_cmd("image", "exists", image)))
+    api = podman_api()
+    if api is not None:
+        image_exists = api.exists(image)
+
+    else:
+        image_exists = not _execute(shlex.join(podman_cmd("image", "exists", image)))
+
     if image_exists or not remote:
         return image_exists
 
-    image = image_qualified_name(image)
-    registry, image, tag, ref = image_name_parts(image)
-    if ref is not None:
+    ref = image_ref(image)
+    if ref.digest is not None:
         raise NotImplementedError()
 
-    tags = image_tags(f"{registry}/{image}", skip_manifest=skip_manifest)
-    if not tag:
+    tags = image_tags(f"{ref.registry}/{ref.repo}", skip_manifest=skip_manifest)
+    if not ref.tag:
         return bool(tags)
 
-    return tag in tags
+    return ref.tag in tags
 
 
 def image_tags(image: str, skip_manifest: bool = False) -> list[str]:
-    image = image_qualified_name(image)
-    registry, image, _, _ = image_name_parts(image)
-    if (
-        not skip_manifest
-        and registry == REGISTRY
-        and image == IMAGE
-        and _latest_manifest()
-    ):
-        tags = [
-            x[19:]
-            for x in image_labels(f"{REPO}:_manifest", False).keys()
-            if x.startswith("arkes.manifest.tag.")
-        ]
+    ref = image_ref(image)
+    registry, image = ref.registry, ref.repo
+    if not skip_manifest and registry == REGISTRY and image == IMAGE:
+        tags = manifest_session.tags()
         if tags:
             return ["_manifest", *tags]
 
+    if REGISTRY_BACKEND == "native":
+        assert registry is not None, f"{image} has no registry"
+        return get_registry(registry).tags(image)
+
     data: dict[str, str | list[str]] = json.loads(  # pyright:ignore [reportAny]
         subprocess.check_output(
             [
@@ -244,6 +372,7 @@ def image_tags(image: str, skip_manifest: bool = False) -> list[str]:
     return tags
 
 
+@lru_cache(maxsize=IMAGE_REF_CACHE_SIZE)
 def image_name_parts(name: str) -> tuple[str | None, str, str | None, str | None]:
     registry = None
     tag = None
@@ -261,9 +390,10 @@ def image_name_parts(name: str) -> tuple[str | None, str, str | None, str | None
     if ":" in name:
         name, tag = name.split(":", 1)
 
-    return registry, name, tag, ref
+    return registry, str(name), tag, ref
 
 
+@lru_cache(maxsize=IMAGE_REF_CACHE_SIZE)
 def image_name_from_parts(
     registry: str | None,
     repo: str,
@@ -296,7 +426,45 @@ def image_name_from_parts(
     return f"{prefix}{repo}{suffix}"
 
 
-def image_qualified_name(image: str) -> str:
+class ImageRef(str):
+    # A qualified image name. As a str it can be passed anywhere an image name
+    # is expected, and the parts are only parsed once
+    __slots__: tuple[str, ...] = ()
+
+    @property
+    def registry(self) -> str | None:
+        return image_name_parts(self)[0]
+
+    @property
+    def repo(self) -> str:
+        return image_name_parts(self)[1]
+
+    @property
+    def tag(self) -> str | None:
+        return image_name_parts(self)[2]
+
+    @property
+    def digest(self) -> str | None:
+        return image_name_parts(self)[3]
+
+    @property
+    def qualified(self) -> str:
+        return str(self)
+
+
+def image_ref(image: str) -> ImageRef:
+    if isinstance(image, ImageRef):
+        return image
+
+    return _image_ref(image)
+
+
+def image_qualified_name(image: str) -> ImageRef:
+    return image_ref(image)
+
+
+@lru_cache(maxsize=IMAGE_REF_CACHE_SIZE)
+def _image_ref(image: str) -> ImageRef:
     registry, repo, tag, digest = image_name_parts(image)
     if ((registry or REGISTRY) == REGISTRY) and repo == IMAGE:
         registry = REGISTRY
@@ -308,10 +476,14 @@ def image_qualified_name(image: str) -> str:
     if tag and digest:
         tag = None
 
-    return image_name_from_parts(registry, repo, tag, digest)
+    return ImageRef(image_name_from_parts(registry, repo, tag, digest))
 
 
 def _image_digest_remote(image: str) -> str:
+    if REGISTRY_BACKEND == "native":
+        name, repo, reference = _native_reference(image)
+        return get_registry(name).digest(repo, reference)
+
     return (
         subprocess.check_output(
             [
@@ -326,19 +498,163 @@ def _image_digest_remote(image: str) -> str:
     )
 
 
-def _latest_manifest() -> bool:
-    return (
-        subprocess.run(
-            podman_cmd("pull", f"{REPO}:_manifest"),
+def encode_delta_map(
+    target: str, routes: dict[str, list[str]], digests: dict[str, int]
+) -> str:
+    # Every route ends at target, so the routes are stored as a tree rooted at
+    # target where each entry is a digest and the entry of its next hop.
+    # Sources are flagged in the top bit, as some entries are only used as an
+    # intermediate hop.
+    entries: dict[tuple[int, int], int] = {(digests[target], 0xFFFFFFFF): 0}
+    sources: set[int] = set()
+    for source, path in routes.items():
+        assert path and path[0][6:].split("-")[0] == source, (
+            f"Route does not start at {source}"
+        )
+        entry = 0
+        for tag in reversed(path):
+            entry = entries.setdefault(
+                (digests[tag[6:].split("-")[0]], entry), len(entries)
+            )
+
+        sources.add(entry)
+
+    return base64.b64encode(
+        struct.pack(
+            f"<{len(entries) * 2}I",
+            *[
+                x
+                for i, (digest, next_entry) in enumerate(entries.keys())
+                for x in (digest | (0x80000000 if i in sources else 0), next_entry)
+            ],
+        )
+    ).decode("ascii")
+
+
+class DeltaMap(Mapping[str, list[str]]):
+    def __init__(self, data: str, digests: list[str]):
+        raw = base64.b64decode(data)
+        self._table: tuple[int, ...] = struct.unpack(f"<{len(raw) // 4}I", raw)
+        self._digests: list[str] = digests
+        # Only the sources are indexed, paths are built when they are looked up
+        self._sources: dict[str, int] = {
+            digests[self._table[i] & 0x7FFFFFFF]: i // 2
+            for i in range(0, len(self._table), 2)
+            if self._table[i] & 0x80000000
+        }
+
+    def _node(self, entry: int) -> str:
+        return self._digests[self._table[entry * 2] & 0x7FFFFFFF]
+
+    @override
+    def __getitem__(self, key: str) -> list[str]:
+        entry = self._sources[key]
+        path: list[str] = []
+        while (next_entry := self._table[entry * 2 + 1]) != 0xFFFFFFFF:
+            path.append(f"_diff-{self._node(entry)}-{self._node(next_entry)}")
+            entry = next_entry
+
+        return path
+
+    @override
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sources)
+
+    @override
+    def __len__(self) -> int:
+        return len(self._sources)
+
+
+class ManifestSession:
+    def __init__(self, image: str = f"{REPO}:_manifest", ttl: float = MANIFEST_TTL):
+        self.image: str = image
+        self.ttl: float = ttl
+        self._tags: dict[str, str] = {}
+        self._maps: dict[str, str] = {}
+        self._digests: list[str] = []
+        self._version: int = 1
+        self._fetched: float | None = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def _refresh(self) -> bool:
+        self._fetched = time()
+        tags: dict[str, str] = {}
+        maps: dict[str, str] = {}
+        digests: list[str] = []
+        version = 1
+        ok = not subprocess.run(
+            podman_cmd("pull", self.image),
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
         ).returncode
-        == 0
-    )
+        if ok:
+            for key, value in image_labels(self.image, False).items():
+                if key.startswith("arkes.manifest.tag."):
+                    tags[key[19:]] = value
+
+                elif key.startswith("arkes.manifest.map."):
+                    maps[key[19:]] = value
+
+                elif key == "arkes.manifest.digests":
+                    digests = value.split(",")
+
+                elif key == "arkes.manifest.version":
+                    version = int(value)
+
+        self._tags = tags
+        self._maps = maps
+        self._digests = digests
+        self._version = version
+        return ok
+
+    def refresh(self) -> bool:
+        with self._lock:
+            return self._refresh()
+
+    def _ensure(self):
+        # A failed pull is also cached for the TTL, so being offline does not
+        # mean trying to pull the manifest on every lookup
+        with self._lock:
+            if self._fetched is None or time() - self._fetched > self.ttl:
+                _ = self._refresh()
+
+    def tags(self) -> list[str]:
+        self._ensure()
+        return list(self._tags.keys())
+
+    def digest(self, tag: str) -> str | None:
+        self._ensure()
+        return self._tags.get(tag)
+
+    def targets(self) -> list[str]:
+        self._ensure()
+        return list(self._maps.keys())
+
+    def delta_map(self, b62: str) -> Mapping[str, list[str]]:
+        self._ensure()
+        data = self._maps.get(b62)
+        if data is None:
+            return {}
+
+        # Clients that predate the manifest version fall back to direct deltas
+        if self._version > MANIFEST_VERSION:
+            return {}
+
+        if self._version == 1:
+            return cast(dict[str, list[str]], json.loads(data))
+
+        return DeltaMap(data, self._digests)
+
+
+manifest_session = ManifestSession()
 
 
 def image_digest(image: str, remote: bool = True) -> str:
     image = image_qualified_name(image)
+    api = podman_api()
+    if not remote and api is not None:
+        return cast(str, api.inspect(image)["Digest"])
+
     if not remote:
         return (
             subprocess.check_output(
@@ -349,30 +665,98 @@ def image_digest(image: str, remote: bool = True) -> str:
         )
 
     registry, repo, tag, _ = image_name_parts(image)
-    if tag and registry == REGISTRY and repo == IMAGE and _latest_manifest():
-        return image_labels(f"{REPO}:_manifest", False).get(
-            f"arkes.manifest.tag.{tag}",
-            _image_digest_remote(image),
-        )
+    if tag and registry == REGISTRY and repo == IMAGE:
+        digest = manifest_session.digest(tag)
+        if digest is not None:
+            return digest
 
     return _image_digest_remote(image)
 
 
-def image_size(image: str) -> int:
+def _image_manifest(image: str) -> tuple[str, dict[str, list[dict[str, int]]]]:
     image = image_qualified_name(image)
-    manifest: dict[str, list[dict[str, int]]] = json.loads(  # pyright: ignore[reportAny]
-        subprocess.check_output(
-            [
-                "skopeo",
-                "inspect",
-                f"docker://{image}",
-                "--raw",
-            ]
-        )
+    if REGISTRY_BACKEND == "native":
+        name, repo, reference = _native_reference(image)
+        digest, manifest = get_registry(name).manifest(repo, reference)
+        return digest, cast(dict[str, list[dict[str, int]]], manifest)
+
+    raw = subprocess.check_output(
+        [
+            "skopeo",
+            "inspect",
+            f"docker://{image}",
+            "--raw",
+        ]
+    )
+    return (
+        f"sha256:{sha256(raw).hexdigest()}",
+        cast(dict[str, list[dict[str, int]]], json.loads(raw)),
     )
-    layers = manifest.get("layers", [])
+
+
+def _manifest_layers(
+    manifest: dict[str, list[dict[str, int]]],
+) -> list[tuple[str, int]]:
     # TODO when multiarch images are added, update this to handle that
-    return 0 if not layers else sum(layer.get("size", 0) for layer in layers)
+    return [
+        (cast(str, layer["digest"]), layer.get("size", 0))
+        for layer in cast(list[dict[str, Any]], manifest.get("layers", []))  # pyright: ignore[reportExplicitAny]
+    ]
+
+
+def _image_layers(image: str) -> list[tuple[str, int]]:
+    return _manifest_layers(_image_manifest(image)[1])
+
+
+def image_size(image: str) -> int:
+    return sum(size for _, size in _image_layers(image))
+
+
+def image_digest_and_size(image: str) -> tuple[str, int]:
+    # Both come from the same manifest, so only one request is needed
+    digest, manifest = _image_manifest(image)
+    return digest, sum(size for _, size in _manifest_layers(manifest))
+
+
+def estimate_delta_ratio(imageA: str, imageB: str) -> float | None:
+    try:
+        layersA = dict(_image_layers(imageA))
+        layersB = _image_layers(imageB)
+
+    except (subprocess.CalledProcessError, RegistryError):
+        return None
+
+    total = sum(size for _, size in layersB)
+    if not total:
+        return None
+
+    # The share of the image in layers that changed. A rebuilt layer usually
+    # still has most of its content in the old archive, so this is only an
+    # upper bound until it is calibrated against real deltas
+    return sum(size for digest, size in layersB if digest not in layersA) / total
+
+
+def predict_delta_ratio(
+    estimate: float, history: Iterable[tuple[float, float]]
+) -> float | None:
+    # history holds the estimate and real ratio of past encodes. Use the lower
+    # quartile of how much of the changed layers ended up in the delta, so a
+    # pair is only predicted to fail when most past pairs like it did
+    factors = sorted(ratio / x for x, ratio in history if x >= 0.05)
+    if len(factors) < DELTA_HISTORY_MIN:
+        return None
+
+    return estimate * factors[len(factors) // 4]
+
+
+def delta_is_hopeless(
+    estimate: float | None, history: Iterable[tuple[float, float]]
+) -> bool:
+    if estimate is None:
+        return False
+
+    ratio = predict_delta_ratio(estimate, history)
+    return ratio is not None and ratio >= MAX_SIZE_RATIO * ESTIMATE_MARGIN
 
 
 CONTAINER_POST_STEPS = r"""
@@ -514,6 +898,51 @@ def export(
         yield tarfile.open(fileobj=stdout, mode="r|*")
 
 
+class TagInfo(NamedTuple):
+    kind: str
+    variant: str | None = None
+    version: str | None = None
+    build: str | None = None
+    src: str | None = None
+    dst: str | None = None
+
+
+# The registry limits tags to [A-Za-z0-9_.-], so a single pattern over every
+# tag joined by newlines can classify them all in one pass
+_TAG_PATTERN = re.compile(
+    r"^((_manifest)"
+    + r"|_diff-([0-9A-Za-z]{1,43})-([0-9A-Za-z]{1,43})"
+    + r"|([A-Za-z0-9-]+)(?:_([A-Za-z0-9.-]+\.([0-9]+)|[A-Za-z0-9.-]+))?)$",
+    re.MULTILINE,
+)
+_OTHER_TAG = TagInfo("other")
+
+
+def classify_tags(tags: Iterable[str]) -> dict[str, TagInfo]:
+    table = dict.fromkeys(tags, _OTHER_TAG)
+    for tag, manifest, src, dst, variant, version, build in cast(
+        list[tuple[str, ...]], _TAG_PATTERN.findall("\n".join(table))
+    ):
+        if manifest:
+            row = ("manifest", None, None, None, None, None)
+
+        elif src:
+            row = ("diff", None, None, None, src, dst)
+
+        elif not version:
+            row = ("variant", variant, None, None, None, None)
+
+        elif build:
+            row = ("build", variant, version, build, None, None)
+
+        else:
+            row = ("version", variant, version, None, None, None)
+
+        table[tag] = TagInfo._make(row)
+
+    return table
+
+
 def hex_to_base62(hex_digest: str) -> str:
     if hex_digest.startswith("sha256:"):
         hex_digest = hex_digest[7:]
@@ -618,62 +1047,500 @@ def _save_image_to_file(image: str, path: str):
     tar_proc, tmpdir = _save_image(image)
     assert tar_proc.stdout is not None
     with open(path, "wb") as f:
-        for line in tar_proc.stdout:
-            _ = f.write(line)
-            f.flush()
+        shutil.copyfileobj(tar_proc.stdout, f, 1024 * 1024)
 
     _wait_for_processes(tar_proc, cleanup=tmpdir.cleanup)
 
 
-def escape_label(value: str) -> str:
-    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\\n")
+class ArchiveCache:
+    def __init__(self, path: str, max_size: int):
+        self.path: str = path
+        self.max_size: int = max_size
+        self._lock: threading.Lock = threading.Lock()
+        self._locks: dict[str, threading.Lock] = {}
+        self._in_use: Counter[str] = Counter()
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def archive(self, image: str) -> Generator[str, None, None]:
+        # The normalised archive is deterministic, so it can be keyed by the
+        # digest of the image it was saved from
+        name = f"{hex_to_base62(image_digest(image, remote=False))}.oci"
+        path = os.path.join(self.path, name)
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+            self._in_use[name] += 1
+
+        try:
+            with lock:
+                if os.path.exists(path):
+                    os.utime(path)
+
+                else:
+                    _save_image_to_file(image, f"{path}.tmp")
+                    os.replace(f"{path}.tmp", path)
+                    self.evict()
+
+            yield path
+
+        finally:
+            with self._lock:
+                self._in_use[name] -= 1
+
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = sorted(
+                (x.stat().st_mtime, x.name, x.stat().st_size)
+                for x in os.scandir(self.path)
+                if x.name.endswith(".oci")
+            )
+            total = sum(x[2] for x in entries)
+            for _, name, size in entries:
+                if total <= self.max_size:
+                    break
+
+                if self._in_use[name]:
+                    continue
+
+                os.unlink(os.path.join(self.path, name))
+                total -= size
+
+
+@lru_cache(maxsize=None)
+def archive_cache() -> ArchiveCache | None:
+    if not ARCHIVE_CACHE_SIZE:
+        return None
+
+    return ArchiveCache(ARCHIVE_CACHE_PATH, ARCHIVE_CACHE_SIZE)
+
+
+def _pipeline(
+    *cmds: list[str], stdin: IO[bytes] | None = None
+) -> list[subprocess.Popen[bytes]]:
+    procs: list[subprocess.Popen[bytes]] = []
+    for i, cmd in enumerate(cmds):
+        proc = subprocess.Popen(
+            cmd,
+            stdin=stdin,
+            stdout=subprocess.PIPE if i < len(cmds) - 1 else None,
+        )
+        if stdin is not None:
+            stdin.close()
+
+        stdin = proc.stdout
+        procs.append(proc)
+
+    return procs[::-1]
+
+
+def _delta_encode_cmds(
+    profile: str, old_path: str, new_path: str, diff_path: str
+) -> list[list[str]]:
+    patch_format, xdelta3_args, zstd_args = DELTA_PROFILES[profile]
+    if patch_format == "zstd-patch":
+        return [
+            [
+                "zstd",
+                "-q",
+                "-f",
+                *zstd_args,
+                f"--patch-from={old_path}",
+                new_path,
+                "-o",
+                diff_path,
+            ]
+        ]
+
+    return [
+        ["xdelta3", "-e", *xdelta3_args, "-s", old_path, new_path, "-"],
+        ["zstd", "-q", "-f", *zstd_args, "-o", diff_path],
+    ]
+
+
+def _delta_decode_cmds(
+    patch_format: str, old_path: str, diff_path: str, new_path: str
+) -> list[list[str]]:
+    if patch_format == "zstd-patch":
+        return [
+            [
+                "zstd",
+                "-q",
+                "-d",
+                "-f",
+                "--long=31",
+                f"--patch-from={old_path}",
+                diff_path,
+                "-o",
+                new_path,
+            ]
+        ]
+
+    return [
+        ["zstdcat", diff_path],
+        ["xdelta3", "-d", "-f", "-s", old_path, "-", new_path],
+    ]
+
+
+def _save_image_layout(image: str, path: str):
+    _ = subprocess.check_call(
+        [
+            "skopeo",
+            "copy",
+            "--remove-signatures",
+            f"containers-storage:{image}",
+            f"oci:{path}",
+        ]
+    )
+
+
+def _layout_blob(path: str, media_type: str, data: bytes) -> dict[str, str | int]:
+    digest = sha256(data).hexdigest()
+    with open(os.path.join(path, "blobs", "sha256", digest), "wb") as f:
+        _ = f.write(data)
 
+    return {"mediaType": media_type, "digest": f"sha256:{digest}", "size": len(data)}
 
-def create_delta(imageA: str, imageB: str, imageD: str, pull: bool = True) -> bool:
-    digestA = image_digest(imageA, remote=False)
-    digestB = image_digest(imageB, remote=False)
+
+def _reset_tarinfo(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.mtime = 0
+    return info
+
+
+def write_image_layout(
+    path: str, labels: dict[str, str], files: list[str] | None = None
+):
+    # The equivalent of a FROM scratch Containerfile with only LABEL and
+    # COPY lines, where every file is copied to / in a single layer
+    blobs = os.path.join(path, "blobs", "sha256")
+    os.makedirs(blobs, exist_ok=True)
+    layers: list[dict[str, str | int]] = []
+    if files:
+        layer = os.path.join(blobs, "layer.tar")
+        with tarfile.open(layer, "w", format=tarfile.PAX_FORMAT) as tar:
+            for file in files:
+                tar.add(file, arcname=os.path.basename(file), filter=_reset_tarinfo)
+
+        with open(layer, "rb") as f:
+            digest = file_digest(f, "sha256").hexdigest()
+
+        os.rename(layer, os.path.join(blobs, digest))
+        layers.append(
+            {
+                "mediaType": "application/vnd.oci.image.layer.v1.tar",
+                "digest": f"sha256:{digest}",
+                "size": os.path.getsize(os.path.join(blobs, digest)),
+            }
+        )
+
+    config = _layout_blob(
+        path,
+        "application/vnd.oci.image.config.v1+json",
+        json.dumps(
+            {
+                "created": datetime.now(tz=UTC).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "architecture": ARCHITECTURE,
+                "os": "linux",
+                "config": {"Labels": labels},
+                "rootfs": {
+                    "type": "layers",
+                    "diff_ids": [x["digest"] for x in layers],
+                },
+            }
+        ).encode("utf-8"),
+    )
+    manifest = _layout_blob(
+        path,
+        "application/vnd.oci.image.manifest.v1+json",
+        json.dumps(
+            {
+                "schemaVersion": 2,
+                "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                "config": config,
+                "layers": layers,
+            }
+        ).encode("utf-8"),
+    )
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump({"schemaVersion": 2, "manifests": [manifest]}, f)
+
+    with open(os.path.join(path, "oci-layout"), "w") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+
+
+def create_image(
+    image: str,
+    labels: dict[str, str],
+    files: list[str] | None = None,
+    push: bool = False,
+):
     with TemporaryDirectory() as tmpdir:
-        old_oci_path = os.path.join(tmpdir, "old.oci")
-        try:
-            _save_image_to_file(imageA, old_oci_path)
-            tar_proc, tardir = _save_image(imageB)
-            assert tar_proc.stdout is not None
-            xdelta_proc = subprocess.Popen(
-                ["xdelta3", "-0", "-S", "none", "-s", old_oci_path, "-", "-"],
-                stdin=tar_proc.stdout,
-                stdout=subprocess.PIPE,
+        write_image_layout(tmpdir, labels, files)
+        for dest in [
+            f"containers-storage:{image}",
+            *([f"docker://{image}"] if push else []),
+        ]:
+            _ = subprocess.check_call(["skopeo", "copy", f"oci:{tmpdir}", dest])
+
+
+def _image_layout_layers(path: str) -> list[str]:
+    with open(os.path.join(path, "index.json"), "r") as f:
+        index = cast(dict[str, list[dict[str, str]]], json.load(f))
+
+    with open(
+        os.path.join(path, "blobs", *index["manifests"][0]["digest"].split(":", 1)),
+        "r",
+    ) as f:
+        manifest = cast(dict[str, list[dict[str, str]]], json.load(f))
+
+    return [x["digest"].split(":", 1)[1] for x in manifest.get("layers", [])]
+
+
+def _create_layer_delta(
+    old_dir: str, new_dir: str, tmpdir: str, profile: str = "layers"
+) -> str:
+    _, _, zstd_args = DELTA_PROFILES[profile]
+    patch_dir = os.path.join(tmpdir, "patch")
+    old_blobs = set(os.listdir(os.path.join(old_dir, "blobs", "sha256")))
+    old_layers = _image_layout_layers(old_dir)
+    # Changed layers are diffed against the layer in the same position of the
+    # old image, which is where the same content usually lives between builds
+    sources = {
+        layer: old_layers[min(i, len(old_layers) - 1)]
+        for i, layer in enumerate(_image_layout_layers(new_dir))
+        if old_layers
+    }
+    files: dict[str, dict[str, str]] = {}
+    for root, _, names in os.walk(new_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, new_dir)
+            out = os.path.join(patch_dir, rel)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            if rel.startswith("blobs/") and name in old_blobs:
+                files[rel] = {"type": "ref"}
+                continue
+
+            source = sources.get(name)
+            if source is None:
+                files[rel] = {"type": "zstd"}
+                _ = subprocess.check_call(
+                    ["zstd", "-q", *zstd_args, path, "-o", f"{out}.zst"]
+                )
+                continue
+
+            files[rel] = {"type": "xdelta3", "source": f"blobs/sha256/{source}"}
+            _wait_for_processes(
+                *_pipeline(
+                    *_delta_encode_cmds(
+                        profile,
+                        os.path.join(old_dir, files[rel]["source"]),
+                        path,
+                        f"{out}.xd3.zst",
+                    )
+                )
             )
-            tar_proc.stdout.close()
-            assert xdelta_proc.stdout is not None
-            diff_path = os.path.join(tmpdir, "diff.xd3.zstd")
-            zstd_proc = subprocess.Popen(
-                ["zstd", "-19", "-T0", "-o", diff_path],
-                stdin=xdelta_proc.stdout,
-                stdout=subprocess.PIPE,
+
+    with open(os.path.join(patch_dir, "patch.json"), "w") as f:
+        json.dump({"files": files}, f)
+
+    diff_path = os.path.join(tmpdir, PATCH_FILES["layers+xdelta3+zstd"])
+    _ = subprocess.check_call(
+        ["tar", "--create", f"--file={diff_path}", f"--directory={patch_dir}", "."]
+    )
+    shutil.rmtree(patch_dir)
+    return diff_path
+
+
+def _apply_layer_delta(old_dir: str, patch_dir: str, new_dir: str):
+    with open(os.path.join(patch_dir, "patch.json"), "r") as f:
+        files = cast(dict[str, dict[str, dict[str, str]]], json.load(f))["files"]
+
+    for rel, entry in files.items():
+        out = os.path.join(new_dir, rel)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        match entry["type"]:
+            case "ref":
+                try:
+                    os.link(os.path.join(old_dir, rel), out)
+
+                except OSError:
+                    _ = shutil.copy2(os.path.join(old_dir, rel), out)
+
+            case "zstd":
+                _ = subprocess.check_call(
+                    [
+                        "zstd",
+                        "-q",
+                        "-d",
+                        os.path.join(patch_dir, f"{rel}.zst"),
+                        "-o",
+                        out,
+                    ]
+                )
+
+            case "xdelta3":
+                _wait_for_processes(
+                    *_pipeline(
+                        *_delta_decode_cmds(
+                            "xdelta3+zstd",
+                            os.path.join(old_dir, entry["source"]),
+                            os.path.join(patch_dir, f"{rel}.xd3.zst"),
+                            out,
+                        )
+                    )
+                )
+
+            case _:
+                raise ValueError(f"Unknown patch entry type {entry['type']}")
+
+
+def encode_delta(profile: str, old_path: str, new_path: str, diff_path: str):
+    if DELTA_PROFILES[profile][0] == "layers+xdelta3+zstd":
+        with TemporaryDirectory(dir=os.path.dirname(diff_path)) as tmpdir:
+            os.replace(
+                _create_layer_delta(old_path, new_path, tmpdir, profile), diff_path
             )
-            xdelta_proc.stdout.close()
-            _ = zstd_proc.communicate()
-            _wait_for_processes(
-                zstd_proc,
-                xdelta_proc,
-                tar_proc,
-                cleanup=tardir.cleanup,
+
+        return
+
+    _wait_for_processes(
+        *_pipeline(*_delta_encode_cmds(profile, old_path, new_path, diff_path))
+    )
+
+
+def decode_delta(patch_format: str, old_path: str, diff_path: str, new_path: str):
+    if patch_format == "layers+xdelta3+zstd":
+        with TemporaryDirectory(dir=os.path.dirname(new_path)) as patch_dir:
+            _ = subprocess.check_call(
+                ["tar", "--extract", f"--file={diff_path}", f"--directory={patch_dir}"]
             )
-            sizeA = os.path.getsize(old_oci_path)
-            sizeB = image_size(imageB)
-            sizeD = os.path.getsize(diff_path)
-            maxSize = int(sizeB * MAX_SIZE_RATIO)
-            print(f"Size of {imageA}: {bytes_to_iec(sizeA)}")
-            print(f"Size of {imageB}: {bytes_to_iec(sizeB)}")
-            print(f"Size of delta: {bytes_to_iec(sizeD)}")
-            print(f"Threshhold size: {bytes_to_iec(maxSize)}")
-            success = sizeD < maxSize
-            if not success:
-                print("Delta too large to use")
-
-        except ExceptionGroup:  # noqa: F821
-            print("Failed to genrate delta")
-            success = False
+            _apply_layer_delta(old_path, patch_dir, new_path)
+
+        return
+
+    _wait_for_processes(
+        *_pipeline(*_delta_decode_cmds(patch_format, old_path, diff_path, new_path))
+    )
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\\n")
+
+
+def _create_archive_delta(
+    imageA: str,
+    imageB: str,
+    old_oci_path: str,
+    diff_path: str,
+    cache: ArchiveCache | None,
+    stack: ExitStack,
+    profile: str,
+) -> int:
+    procs: list[subprocess.Popen[bytes]] = []
+    cleanup: Callable[[], None] | None = None
+    if cache is None:
+        _save_image_to_file(imageA, old_oci_path)
+        tar_proc, tardir = _save_image(imageB)
+        assert tar_proc.stdout is not None
+        new_oci = tar_proc.stdout
+        procs.append(tar_proc)
+        cleanup = tardir.cleanup
+
+    else:
+        old_oci_path = stack.enter_context(cache.archive(imageA))
+        new_oci = open(stack.enter_context(cache.archive(imageB)), "rb")
+
+    _wait_for_processes(
+        *_pipeline(
+            *_delta_encode_cmds(profile, old_oci_path, "-", diff_path), stdin=new_oci
+        ),
+        *procs,
+        cleanup=cleanup,
+    )
+    return os.path.getsize(old_oci_path)
+
+
+def create_delta(
+    imageA: str,
+    imageB: str,
+    imageD: str,
+    pull: bool = True,
+    cache: ArchiveCache | None = None,
+    profile: str = DEFAULT_DELTA_PROFILE,
+    skip_encode: bool = False,
+    onratio: Callable[[float], None] | None = None,
+) -> bool:
+    assert profile in DELTA_PROFILES, f"Unknown delta profile {profile}"
+    patch_format = DELTA_PROFILES[profile][0]
+    # Skipped pairs may never have been pulled
+    digestA = image_digest(imageA, remote=not image_exists(imageA, remote=False))
+    digestB = image_digest(imageB, remote=not image_exists(imageB, remote=False))
+    with TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        old_oci_path = os.path.join(tmpdir, "old.oci")
+        diff_path = os.path.join(tmpdir, PATCH_FILES[patch_format])
+        success = False
+        if skip_encode:
+            print("Delta predicted to be too large to use")
+
+        else:
+            try:
+                if patch_format == "layers+xdelta3+zstd":
+                    old_dir = os.path.join(tmpdir, "old")
+                    new_dir = os.path.join(tmpdir, "new")
+                    _save_image_layout(imageA, old_dir)
+                    _save_image_layout(imageB, new_dir)
+                    diff_path = _create_layer_delta(old_dir, new_dir, tmpdir, profile)
+                    sizeA = sum(
+                        os.path.getsize(os.path.join(root, name))
+                        for root, _, names in os.walk(old_dir)
+                        for name in names
+                    )
+                    shutil.rmtree(old_dir)
+                    shutil.rmtree(new_dir)
+
+                else:
+                    sizeA = _create_archive_delta(
+                        imageA, imageB, old_oci_path, diff_path, cache, stack, profile
+                    )
+
+                sizeB = image_size(imageB)
+                sizeD = os.path.getsize(diff_path)
+                maxSize = int(sizeB * MAX_SIZE_RATIO)
+                print(f"Size of {imageA}: {bytes_to_iec(sizeA)}")
+                print(f"Size of {imageB}: {bytes_to_iec(sizeB)}")
+                print(f"Size of delta: {bytes_to_iec(sizeD)}")
+                print(f"Threshhold size: {bytes_to_iec(maxSize)}")
+                success = sizeD < maxSize
+                if onratio is not None and sizeB:
+                    onratio(sizeD / sizeB)
+
+                if not success:
+                    print("Delta too large to use")
+
+            except ExceptionGroup:  # noqa: F821
+                if patch_format == "zstd-patch":
+                    # zstd can only reference a window of up to 2GiB, so very
+                    # large archives have to use xdelta3 instead
+                    print(
+                        f"Failed to generate delta, falling back to {DEFAULT_DELTA_PROFILE}"
+                    )
+                    return create_delta(
+                        imageA,
+                        imageB,
+                        imageD,
+                        pull,
+                        cache,
+                        DEFAULT_DELTA_PROFILE,
+                        False,
+                        onratio,
+                    )
+
+                print("Failed to genrate delta")
+                success = False
 
         labels: dict[str, str] = {
             "description": f"Delta between {imageA} and {imageB}",
@@ -697,40 +1564,79 @@ def create_delta(imageA: str, imageB: str, imageD: str, pull: bool = True) -> bo
             if full_label in src_labels:
                 labels[label] = src_labels[full_label]
 
-        containerfile = os.path.join(tmpdir, "Containerfile")
-        patch_format = "xdelta3+zstd" if success else "pull"
-        with open(containerfile, "w") as f:
-            _ = f.write(f"""\
-FROM scratch
-LABEL {"\n  ".join([f'org.opencontainers.image.{k}="{escape_label(v)}" \\' for k, v in labels.items()])}
-  arkes.patch.prev="{digestA}" \\
-  arkes.patch.ref="{digestB}" \\
-  arkes.patch.format="{patch_format}"
-""")
-            match patch_format:
-                case "pull":
-                    print("Creating empty delta instead")
-
-                case "xdelta3+zstd":
-                    _ = f.write("COPY diff.xd3.zstd /diff.xd3.zstd\n")
-
-        podman(
-            "build",
-            f"--tag={imageD}",
-            f"--file={containerfile}",
-            "--force-rm",
-            f"--pull={'newer' if pull else 'never'}",
-            tmpdir,
+        patch_format = patch_format if success else "pull"
+        if patch_format == "pull":
+            print("Creating empty delta instead")
+
+        create_image(
+            imageD,
+            {
+                **{f"org.opencontainers.image.{k}": v for k, v in labels.items()},
+                "arkes.patch.prev": digestA,
+                "arkes.patch.ref": digestB,
+                "arkes.patch.format": patch_format,
+            },
+            [] if patch_format == "pull" else [diff_path],
         )
         return success
 
 
+def _apply_layer_delta_image(
+    image: str,
+    delta_image: str,
+    new_image: str,
+    onstderr: Callable[[bytes], None],
+):
+    with TemporaryDirectory() as tmpdir:
+        old_dir = os.path.join(tmpdir, "old")
+        patch_dir = os.path.join(tmpdir, "patch")
+        new_dir = os.path.join(tmpdir, "new")
+        onstderr(b"Saving old layout\n")
+        _save_image_layout(image, old_dir)
+        onstderr(b"Extracting patch\n")
+        os.makedirs(patch_dir)
+        podman_run_proc = subprocess.Popen(
+            podman_cmd(
+                "run",
+                "--rm",
+                *[
+                    f"--volume={x}:{x}:ro"
+                    for x in ["/usr", "/lib", "/lib64", "/bin", "/var"]
+                ],
+                delta_image,
+                *["cat", f"/{PATCH_FILES['layers+xdelta3+zstd']}"],
+            ),
+            stdout=subprocess.PIPE,
+        )
+        assert podman_run_proc.stdout is not None
+        tar_proc = subprocess.Popen(
+            ["tar", "--extract", f"--directory={patch_dir}"],
+            stdin=podman_run_proc.stdout,
+        )
+        podman_run_proc.stdout.close()
+        _wait_for_processes(tar_proc, podman_run_proc)
+        onstderr(b"Patching layers\n")
+        _apply_layer_delta(old_dir, patch_dir, new_dir)
+        shutil.rmtree(old_dir)
+        shutil.rmtree(patch_dir)
+        _ = subprocess.check_call(
+            [
+                "skopeo",
+                "copy",
+                "--preserve-digests",
+                f"oci:{new_dir}",
+                f"containers-storage:{new_image}",
+            ]
+        )
+
+
 def apply_delta(
     image: str,
     delta_image: str,
     new_image: str,
     onstdout: Callable[[bytes], None] = bytes_to_stdout,
     onstderr: Callable[[bytes], None] = bytes_to_stderr,
+    new_digest: str | None = None,
 ):
     image = image_qualified_name(image)
     if not image_exists(image, remote=False):
@@ -741,24 +1647,40 @@ def apply_delta(
         podman("pull", delta_image, onstdout=onstdout, onstderr=onstderr)
 
     labels = image_labels(delta_image, False)
-    if labels.get("arkes.patch.format", "") != "xdelta3+zstd":
+    patch_format = labels.get("arkes.patch.format", "")
+    if patch_format not in PATCH_FORMATS:
         raise ValueError("Incompatible patch format")
 
     digest = image_digest(image, remote=False)
     if labels.get("arkes.patch.prev", "") != digest:
         raise ValueError("Patch does not apply to this image")
 
-    new_digest = image_digest(new_image, remote=True)
+    if new_digest is None:
+        new_digest = image_digest(new_image, remote=True)
+
     if labels.get("arkes.patch.ref", "") != new_digest:
         raise ValueError("Patch does not result in the correct image")
 
     if not image_exists(image, False) or image_digest(image, False) != digest:
         podman("pull", image, onstdout=onstdout, onstderr=onstderr)
 
-    with TemporaryDirectory() as tmpdir:
-        onstderr(b"Saving old.oci\n")
-        old_oci_path = os.path.join(tmpdir, "old.oci")
-        _save_image_to_file(image, old_oci_path)
+    if patch_format == "layers+xdelta3+zstd":
+        _apply_layer_delta_image(image, delta_image, new_image, onstderr)
+        if image_digest(new_image, remote=False) != new_digest:
+            raise RuntimeError("Resulting image has the wrong digest")
+
+        return
+
+    cache = archive_cache()
+    with TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        if cache is None:
+            onstderr(b"Saving old.oci\n")
+            old_oci_path = os.path.join(tmpdir, "old.oci")
+            _save_image_to_file(image, old_oci_path)
+
+        else:
+            old_oci_path = stack.enter_context(cache.archive(image))
+
         onstderr(b"Patching old.oci\n")
         podman_run_proc = subprocess.Popen(
             podman_cmd(
@@ -769,33 +1691,94 @@ def apply_delta(
                     for x in ["/usr", "/lib", "/lib64", "/bin", "/var"]
                 ],
                 delta_image,
-                *["zstdcat", "--decompress", "--keep", "/diff.xd3.zstd"],
+                *["cat", f"/{PATCH_FILES[patch_format]}"],
             ),
             stdout=subprocess.PIPE,
         )
-        assert podman_run_proc.stdout is not None
-        new_oci_path = os.path.join(tmpdir, "new.oci")
-        xdelta3_proc = subprocess.Popen(
-            ["xdelta3", "-d", "-s", old_oci_path, "-", new_oci_path],
+        # The patched archive is streamed straight into skopeo instead of
+        # being written to disk first, only the source has to be seekable
+        new_oci_fifo = os.path.join(tmpdir, "new.oci")
+        os.mkfifo(new_oci_fifo)
+        decode_procs = _pipeline(
+            *_delta_decode_cmds(patch_format, old_oci_path, "-", new_oci_fifo),
             stdin=podman_run_proc.stdout,
         )
-        podman_run_proc.stdout.close()
-        _ = xdelta3_proc.communicate()
-        _wait_for_processes(xdelta3_proc, podman_run_proc)
-        os.unlink(old_oci_path)
-        _ = subprocess.check_call(
+        skopeo_proc = subprocess.Popen(
             [
                 "skopeo",
                 "copy",
                 "--preserve-digests",
-                f"oci-archive:{new_oci_path}",
+                f"oci-archive:{new_oci_fifo}",
                 f"containers-storage:{new_image}",
             ]
         )
+        _wait_for_processes(skopeo_proc, *decode_procs, podman_run_proc)
+        if cache is None:
+            os.unlink(old_oci_path)
+
         if image_digest(new_image, remote=False) != new_digest:
             raise RuntimeError("Resulting image has the wrong digest")
 
 
+def apply_delta_chain(
+    image: str,
+    path: list[str],
+    new_image: str,
+    new_digest: str,
+    onstdout: Callable[[bytes], None] = bytes_to_stdout,
+    onstderr: Callable[[bytes], None] = bytes_to_stderr,
+):
+    ref = image_ref(image)
+    base_image = f"{ref.registry}/{ref.repo}"
+    current = image
+    intermediates: list[str] = []
+    try:
+        for i, delta_tag in enumerate(path):
+            delta_image = f"{base_image}:{delta_tag}"
+            onstderr(f"Applying delta {delta_tag}\n".encode("utf-8"))
+            try:
+                if i == len(path) - 1:
+                    target, target_digest = new_image, new_digest
+
+                else:
+                    # Intermediate images are never tagged on the remote, so
+                    # the delta itself has to say what it results in
+                    if not image_exists(delta_image, False):
+                        podman(
+                            "pull", delta_image, onstdout=onstdout, onstderr=onstderr
+                        )
+
+                    target_digest = image_labels(delta_image, False).get(
+                        "arkes.patch.ref", ""
+                    )
+                    dst = delta_tag.split("-", 2)[2]
+                    if not target_digest or hex_to_base62(target_digest) != dst:
+                        raise ValueError(f"{delta_tag} does not result in {dst}")
+
+                    target = f"{base_image}:_delta-{dst}"
+                    intermediates.append(target)
+
+                apply_delta(
+                    current,
+                    delta_image,
+                    target,
+                    onstdout=onstdout,
+                    onstderr=onstderr,
+                    new_digest=target_digest,
+                )
+
+            finally:
+                if image_exists(delta_image, remote=False):
+                    podman("rmi", delta_image, onstdout=onstdout, onstderr=onstderr)
+
+            current = target
+
+    finally:
+        for intermediate in intermediates:
+            if image_exists(intermediate, remote=False):
+                podman("rmi", intermediate, onstdout=onstdout, onstderr=onstderr)
+
+
 def pull(
     image: str,
     onstdout: Callable[[bytes], None] = bytes_to_stdout,
@@ -824,7 +1807,9 @@ def pull(
     tags.sort()
     tag_base = target_tag.split("_")[0] if "_" in target_tag else target_tag
     version_tags = [
-        tag for tag in tags if tag.startswith(f"{tag_base}_") and "_" in tag
+        tag
+        for tag, info in classify_tags(tags).items()
+        if info.variant == tag_base and info.kind in ("build", "version")
     ]
     for version_tag in version_tags:
         local_image = f"{base_image}:{version_tag}"
@@ -833,7 +1818,63 @@ def pull(
             candidates.append((local_image, local_digest))
             onstderr(f"Found local version: {local_image}\n".encode("utf-8"))
 
+    # The manifest knows the cheapest chain of deltas from every build it
+    # has routes for, so prefer those over looking for a direct delta
+    delta_map: Mapping[str, list[str]] = {}
+    if registry == REGISTRY and name == IMAGE:
+        delta_map = manifest_session.delta_map(hex_to_base62(remote_digest))
+
+    # Every route ends at the target, so most of their deltas are shared, and
+    # tags pointing to the same local build share the whole route. Only size
+    # each delta once.
+    sizes: dict[str, int] = {}
+    sources: dict[str, str] = {}
+    for local_image, local_digest in candidates:
+        _ = sources.setdefault(hex_to_base62(local_digest), local_image)
+
+    routes: list[tuple[int, str, list[str]]] = []
+    for b62, local_image in sources.items():
+        path = delta_map.get(b62)
+        if not path:
+            continue
+
+        for tag in path:
+            if tag not in sizes:
+                sizes[tag] = image_size(f"{base_image}:{tag}")
+
+        routes.append((sum(sizes[x] for x in path), local_image, path))
+
+    routes.sort()
+    target_size = image_size(image) if routes else 0
+    for cost, local_image, path in routes:
+        if cost >= target_size * MAX_SIZE_RATIO:
+            onstderr(f"Deltas from {local_image} are too large\n".encode("utf-8"))
+            break
+
+        savings_pct = ((target_size - cost) / target_size) * 100
+        onstderr(
+            f"Saving {savings_pct:.1f} of {bytes_to_iec(target_size)} using {len(path)} deltas from {local_image}...\n".encode(
+                "utf-8"
+            )
+        )
+        try:
+            apply_delta_chain(
+                local_image,
+                path,
+                image,
+                remote_digest,
+                onstdout=onstdout,
+                onstderr=onstderr,
+            )
+            return
+
+        except Exception as e:
+            onstderr(f"Delta optimization failed: {e}\n".encode("utf-8"))
+
     for local_image, local_digest in candidates:
+        if hex_to_base62(local_digest) in delta_map:
+            continue
+
         delta_tag = (
             f"_diff-{hex_to_base62(local_digest)}-{hex_to_base62(remote_digest)}"
         )
@@ -848,7 +1889,7 @@ def pull(
             onstderr(b"Wrong digest\n")
             continue
 
-        if delta_labels.get("arkes.patch.format", "none") == "none":
+        if delta_labels.get("arkes.patch.format", "pull") not in PATCH_FORMATS:
             onstderr(b"Empty patch, likely patching will be too large\n")
             continue
 
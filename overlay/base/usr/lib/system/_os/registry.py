@@ -0,0 +1,330 @@
+import json
+import os
+import threading
+
+from hashlib import sha256
+from http.client import HTTPConnection
+from http.client import HTTPException
+from http.client import HTTPResponse
+from http.client import HTTPSConnection
+from email.utils import parsedate_to_datetime
+from time import time
+from typing import cast
+from urllib.parse import urlencode
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+
+MANIFEST_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+INDEX_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+MAX_CONNECTIONS = 8
+# The OCI name for the architecture of this host
+ARCHITECTURE = {"x86_64": "amd64", "aarch64": "arm64"}.get(
+    os.uname().machine, os.uname().machine
+)
+AUTH_FILES = [
+    os.environ.get("REGISTRY_AUTH_FILE", ""),
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR", ""), "containers/auth.json"),
+    f"/run/containers/{os.getuid()}/auth.json",
+    os.path.expanduser("~/.config/containers/auth.json"),
+    os.path.expanduser("~/.docker/config.json"),
+]
+
+
+class RegistryError(Exception):
+    def __init__(
+        self, status: int, reason: str, url: str, retry_after: float | None = None
+    ):
+        super().__init__(f"{status} {reason}: {url}")
+        self.status: int = status
+        self.reason: str = reason
+        self.url: str = url
+        self.retry_after: float | None = retry_after
+
+
+def _retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+
+    if value.isdigit():
+        return float(value)
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+
+    except (TypeError, ValueError):
+        return None
+
+
+class Registry:
+    def __init__(self, registry: str, max_connections: int = MAX_CONNECTIONS):
+        self.registry: str = registry
+        self.host: str = "registry-1.docker.io" if registry == "docker.io" else registry
+        insecure = self.host.startswith(("localhost", "127.0.0.1"))
+        self.base_url: str = f"{'http' if insecure else 'https'}://{self.host}"
+        self.max_connections: int = max_connections
+        self._pools: dict[tuple[str, str], list[HTTPConnection]] = {}
+        self._tokens: dict[str, tuple[str, float]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def _connection(self, scheme: str, netloc: str) -> HTTPConnection:
+        with self._lock:
+            pool = self._pools.setdefault((scheme, netloc), [])
+            if pool:
+                return pool.pop()
+
+        if scheme == "http":
+            return HTTPConnection(netloc, timeout=60)
+
+        return HTTPSConnection(netloc, timeout=60)
+
+    def _release(self, scheme: str, netloc: str, conn: HTTPConnection):
+        with self._lock:
+            pool = self._pools.setdefault((scheme, netloc), [])
+            if len(pool) < self.max_connections:
+                pool.append(conn)
+                return
+
+        conn.close()
+
+    def _send(
+        self, method: str, url: str, headers: dict[str, str]
+    ) -> tuple[HTTPResponse, bytes]:
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers)
+                res = conn.getresponse()
+                body = res.read()
+
+            except (HTTPException, OSError):
+                conn.close()
+                # Pooled connections may have been closed by the server since
+                # they were last used, so retry once with a fresh one
+                if attempt:
+                    raise
+
+                continue
+
+            if res.will_close:
+                conn.close()
+
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+
+            return res, body
+
+        raise AssertionError("unreachable")
+
+    def _credentials(self) -> str | None:
+        for path in AUTH_FILES:
+            if not path or not os.path.exists(path):
+                continue
+
+            with open(path, "r") as f:
+                auths = cast(
+                    dict[str, dict[str, str]],
+                    cast(dict[str, object], json.load(f)).get("auths", {}),
+                )
+
+            for name in (self.registry, f"https://{self.registry}"):
+                if "auth" in auths.get(name, {}):
+                    return auths[name]["auth"]
+
+        return None
+
+    def _token(self, challenge: str, scope: str) -> str:
+        with self._lock:
+            token, expires = self._tokens.get(scope, ("", 0.0))
+
+        if token and expires > time():
+            return token
+
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() != "bearer":
+            raise RegistryError(401, f"Unsupported auth scheme {scheme}", self.host)
+
+        options = {
+            k.strip(): v.strip().strip('"')
+            for x in params.split(",")
+            for k, _, v in [x.partition("=")]
+        }
+        realm = options.pop("realm")
+        options["scope"] = scope
+        headers: dict[str, str] = {}
+        credentials = self._credentials()
+        if credentials is not None:
+            headers["Authorization"] = f"Basic {credentials}"
+
+        url = f"{realm}?{urlencode(options)}"
+        res, body = self._send("GET", url, headers)
+        if res.status != 200:
+            raise RegistryError(
+                res.status,
+                res.reason,
+                url,
+                _retry_after(res.getheader("Retry-After")),
+            )
+
+        data = cast(dict[str, str | int], json.loads(body))
+        token = cast(str, data.get("token") or data["access_token"])
+        # Expire tokens early so they are never used right as they run out
+        expires = time() + cast(int, data.get("expires_in", 60)) - 10
+        with self._lock:
+            self._tokens[scope] = (token, expires)
+
+        return token
+
+    def request(
+        self,
+        method: str,
+        repo: str,
+        path: str,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[HTTPResponse, bytes]:
+        url = f"{self.base_url}/v2/{repo}/{path}"
+        scope = f"repository:{repo}:pull"
+        headers = dict(headers or {})
+        with self._lock:
+            token, expires = self._tokens.get(scope, ("", 0.0))
+
+        if token and expires > time():
+            headers["Authorization"] = f"Bearer {token}"
+
+        authenticated = False
+        for _ in range(5):
+            res, body = self._send(method, url, headers)
+            if res.status == 401 and not authenticated:
+                # Either there was no cached token, or it was revoked early
+                with self._lock:
+                    _ = self._tokens.pop(scope, None)
+
+                challenge = res.getheader("WWW-Authenticate", "")
+                headers["Authorization"] = f"Bearer {self._token(challenge, scope)}"
+                authenticated = True
+                continue
+
+            if res.status in (301, 302, 303, 307, 308):
+                # Blobs are usually served from a CDN, which rejects the
+                # registry token
+                url = urljoin(url, res.getheader("Location", ""))
+                _ = headers.pop("Authorization", None)
+                continue
+
+            if res.status >= 400:
+                raise RegistryError(
+                    res.status,
+                    res.reason,
+                    url,
+                    _retry_after(res.getheader("Retry-After")),
+                )
+
+            return res, body
+
+        raise RegistryError(310, "Too many redirects", url)
+
+    def tags(self, repo: str) -> list[str]:
+        tags: list[str] = []
+        path = "tags/list?n=1000"
+        while path:
+            res, body = self.request("GET", repo, path)
+            tags += cast(dict[str, list[str]], json.loads(body)).get("tags") or []
+            link = res.getheader("Link", "")
+            path = ""
+            if 'rel="next"' in link:
+                path = link[link.index("<") + 1 : link.index(">")].split(
+                    f"/v2/{repo}/", 1
+                )[-1]
+
+        return tags
+
+    def digest(self, repo: str, reference: str) -> str:
+        res, _ = self.request(
+            "HEAD",
+            repo,
+            f"manifests/{reference}",
+            {"Accept": ", ".join(MANIFEST_TYPES)},
+        )
+        digest = res.getheader("Docker-Content-Digest")
+        if digest is not None:
+            return digest
+
+        return self.manifest(repo, reference)[0]
+
+    def manifest(self, repo: str, reference: str) -> tuple[str, dict[str, object]]:
+        res, body = self.request(
+            "GET",
+            repo,
+            f"manifests/{reference}",
+            {"Accept": ", ".join(MANIFEST_TYPES)},
+        )
+        digest = res.getheader("Docker-Content-Digest")
+        if digest is None:
+            digest = f"sha256:{sha256(body).hexdigest()}"
+
+        return digest, cast(dict[str, object], json.loads(body))
+
+    def blob(self, repo: str, digest: str) -> bytes:
+        return self.request("GET", repo, f"blobs/{digest}")[1]
+
+    def inspect(self, repo: str, reference: str) -> dict[str, object]:
+        digest, manifest = self.manifest(repo, reference)
+        if manifest.get("mediaType") in INDEX_TYPES:
+            platforms = [
+                x
+                for x in cast(
+                    list[dict[str, dict[str, str] | str]], manifest["manifests"]
+                )
+                if cast(dict[str, str], x.get("platform", {})).get("os") == "linux"
+                and cast(dict[str, str], x.get("platform", {})).get("architecture")
+                == ARCHITECTURE
+            ]
+            if not platforms:
+                raise RegistryError(404, f"No linux/{ARCHITECTURE} manifest", repo)
+
+            _, manifest = self.manifest(repo, cast(str, platforms[0]["digest"]))
+
+        config_digest = cast(dict[str, str], manifest["config"])["digest"]
+        config = cast(dict[str, object], json.loads(self.blob(repo, config_digest)))
+        container_config = cast(dict[str, object], config.get("config") or {})
+        layers = cast(list[dict[str, str | int]], manifest.get("layers", []))
+        return {
+            "Name": f"{self.registry}/{repo}",
+            "Digest": digest,
+            "Created": config.get("created"),
+            "Architecture": config.get("architecture"),
+            "Os": config.get("os"),
+            "Labels": container_config.get("Labels") or {},
+            "Env": container_config.get("Env") or [],
+            "Layers": [x["digest"] for x in layers],
+            "LayersData": [
+                {
+                    "MIMEType": x.get("mediaType"),
+                    "Digest": x["digest"],
+                    "Size": x.get("size", 0),
+                    "Annotations": x.get("annotations"),
+                }
+                for x in layers
+            ],
+        }
+
+
+_registries: dict[str, Registry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(name: str) -> Registry:
+    with _registries_lock:
+        if name not in _registries:
+            _registries[name] = Registry(name)
+
+        return _registries[name]